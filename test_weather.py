@@ -0,0 +1,569 @@
+"""
+Tests for weather.py
+
+Run with: python -m pytest test_weather.py (or python -m unittest test_weather)
+"""
+import os
+import random
+import datetime
+import itertools
+import tempfile
+import unittest
+from unittest import mock
+import weather
+import weather_batch
+import weather_instrument
+
+_cacheDir = None
+
+def setUpModule():
+    #files opened through the cache go to a directory of their own, removed afterwards
+    global _cacheDir
+    _cacheDir = mock.patch.object(weather.weather_cache, "CACHE_DIR", tempfile.mkdtemp())
+    _cacheDir.start()
+
+def tearDownModule():
+    import shutil
+    shutil.rmtree(weather.weather_cache.CACHE_DIR, ignore_errors=True)
+    _cacheDir.stop()
+
+def quadraticThresholdA(X, F, mode):
+    '''
+    calcThresholdA as it was before the O(n log n) sweep, kept as the reference
+    the sweep must agree with (the "no values" message is dropped, it returns None)
+    '''
+    index1 = 0
+    minimum = 1e9
+    threshold = []
+    value_list = list(X.values())
+    if mode == 'high':
+        for index in range(len(value_list)):  #Replace missing data with exceptionally low values
+            if value_list[index] == None:
+                value_list[index] = -1000
+        while index1 < len(value_list):
+            aboveXindex = [index for index in range(len(value_list)) if value_list[index] >= value_list[index1]]
+            for index in range(len(aboveXindex)-1):
+                difference = abs(aboveXindex[index+1]-aboveXindex[index])
+                if difference < minimum:
+                    minimum = difference
+            if minimum >= F:  #checks if the smallest difference is at least F
+                threshold.append(value_list[index1])
+            minimum = 1e9
+            index1 += 1
+    if mode == 'low':   #Works the same as when mode = high, except the inequalities are reversed
+        for index in range(len(value_list)):
+            if value_list[index] == None:
+                value_list[index] = 1000
+        while index1 < len(value_list):
+            belowXindex = [index for index in range(len(value_list)) if value_list[index] <= value_list[index1]]
+            for index in range(len(belowXindex)-1):
+                difference = abs(belowXindex[index+1]-belowXindex[index])
+                if difference < minimum:
+                    minimum = difference
+            if minimum >= F:
+                threshold.append(value_list[index1])
+            minimum = 1e9
+            index1 += 1
+    if len(threshold) != 0:
+        if mode == 'high':          #Returns smallest threshold for mode == 'high'
+            threshold_value = min(threshold)
+            key = [value for value in X if X[value] == threshold_value]
+            return threshold_value, key
+        if mode == 'low':           #Returns largest threhold for mode == 'low'
+            threshold_value = max(threshold)
+            key = [value for value in X if X[value] == threshold_value]
+            return threshold_value, key
+    return None
+
+class CalcThresholdATest(unittest.TestCase):
+    def check(self, X):
+        for F in (1, 2, 3, 5, 10, 50):
+            for mode in ('high', 'low'):
+                self.assertEqual(weather.calcThresholdA(X, F, mode), quadraticThresholdA(X, F, mode),
+                                 "X=%r F=%d mode=%s" % (X, F, mode))
+
+    def test_random(self):
+        rng = random.Random(1)
+        for case in range(500):
+            n = rng.randint(1, 60)
+            keys = rng.sample(range(100000), n)
+            self.check(dict([(key, round(rng.uniform(-50, 50), 1)) for key in keys]))
+
+    def test_ties_and_missing(self):
+        rng = random.Random(2)
+        for case in range(500):
+            n = rng.randint(1, 60)
+            values = [None if rng.random() < 0.15 else rng.randint(0, rng.choice([1, 3, 10])) for i in range(n)]
+            self.check(dict(enumerate(values)))
+
+    def test_edge_cases(self):
+        self.check({1: None})
+        self.check({1: 5.0})
+        self.check({1: 5.0, 2: 5.0, 3: 5.0})
+        self.check({1: None, 2: None, 3: 7.0})
+
+class QuantileIndexTest(unittest.TestCase):
+    def test_matches_calcThresholdB(self):
+        for n in range(1, 40):
+            values = list(range(n))
+            for F in (1, 2, 3, 7, 50):
+                self.assertEqual(values[weather._quantileIndex(n, F, 'high')], values[-(n//F)])
+                self.assertEqual(values[weather._quantileIndex(n, F, 'low')], values[n//F - 1])
+
+    def test_array_of_counts(self):
+        counts = weather.np.arange(1, 40)
+        for F in (1, 2, 3, 7, 50):
+            for mode in ('high', 'low'):
+                self.assertEqual(weather._quantileIndex(counts, F, mode).tolist(),
+                                 [weather._quantileIndex(n, F, mode) for n in range(1, 40)])
+
+class QuantileSketchTest(unittest.TestCase):
+    def worstError(self, sketch, values):
+        '''
+        The largest distance, as a fraction of the values, between a rank asked for
+        and the ranks the sketch's answer really has
+        '''
+        np = weather.np
+        values = np.sort(values)
+        worst = 0
+        for rank in np.linspace(0, len(values) - 1, 501).astype(np.int64).tolist():
+            answer = sketch.value(rank)
+            low = np.searchsorted(values, answer, "left")
+            high = np.searchsorted(values, answer, "right") - 1
+            worst = max(worst, low - rank, rank - high)
+        return worst/len(values)
+
+    def test_rank_error_within_epsilon(self):
+        np = weather.np
+        for seed in range(4):
+            generator = np.random.default_rng(seed)
+            for values in (generator.normal(size=300000), generator.uniform(size=300000)):
+                for epsilon in (0.01, 0.002):
+                    sketch = weather.QuantileSketch(epsilon, seed)
+                    for start in range(0, len(values), 10000):
+                        sketch.update(values[start:start + 10000])
+                    self.assertLess(self.worstError(sketch, values), epsilon)
+
+    def test_interleaved_stations(self):
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            for interleaved in (False, True):
+                writeStations(path, [70001, 70247, 66062], 4, missing=0.001, interleaved=interleaved)
+                data = weather.openColumns(path, cache=False)
+                for option, month, window in ((1, None, None), (2, 3, None), (3, None, None), (6, None, "DJF")):
+                    filt = ["IDCJAC0009", None, None, month, None, None, None, None]
+                    sketch = weather.sketchAggregate(path, filt, "IDCJAC0009", option, 0.01, chunkRows=97, window=window)
+                    stations = weather.aggregateStations(weather.filterData(data, filt), "IDCJAC0009", option, window)
+                    expected = [value for X in stations.values() for value in X.values() if value != None]
+                    self.assertTrue(expected)
+                    #fewer values than the sketch holds, so it keeps every one of them
+                    self.assertEqual(sorted(weather.np.concatenate(sketch.levels).tolist()), sorted(expected))
+        finally:
+            os.remove(path)
+
+    def test_merged_error_within_epsilon(self):
+        np = weather.np
+        values = np.random.default_rng(7).normal(size=300000)
+        sketch = weather.QuantileSketch(0.01)
+        for part in range(6):
+            other = weather.QuantileSketch(0.01, part)
+            other.update(values[part*50000:(part + 1)*50000])
+            sketch.merge(other)
+        self.assertEqual(len(sketch), len(values))
+        self.assertLess(self.worstError(sketch, values), 0.01)
+
+@weather_instrument.stage("testInner")
+def smallStage():
+    return [0]*1000
+
+@weather_instrument.stage("testOuter")
+def largeStage():
+    large = [0]*1000000
+    del large
+    return smallStage()
+
+def handRows(code, value):
+    '''
+    openData rows for every day of 1900, 2000 and 2004 with "value(year, month, day)",
+    except that 29 February 2004 is missing and 1-2 March 2000 is one observation
+    over two days
+    '''
+    rows = []
+    for year in (1900, 2000, 2004):
+        for month in range(1, 13):
+            for day in range(1, [31, 29 if year%4==0 and year != 1900 else 28, 31, 30, 31, 30,
+                                 31, 31, 30, 31, 30, 31][month - 1] + 1):
+                if (year, month, day) == (2004, 2, 29) or (year, month, day) == (2000, 3, 2):
+                    continue
+                length = 2 if (year, month, day) == (2000, 3, 1) else None
+                rows.append([code, 70247, year, month, day, value(year, month, day), length, "Y"])
+    return rows
+
+class AggregateTest(unittest.TestCase):
+    DAYS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+    def check(self, rows, code, option, expected):
+        for data in (rows, weather._rowColumns(rows)):
+            result = weather.aggregateData(data, code, option)
+            self.assertEqual(result, expected)
+            self.assertEqual(list(result), sorted(expected))
+            self.assertTrue(all([type(key) == int for key in result]))
+
+    def test_rainfall(self):
+        rows = handRows("IDCJAC0009", lambda year, month, day: 2.0 if (year, month, day) == (2000, 3, 1) else 1.0)
+        monthly = {}
+        for year in (1900, 2000, 2004):
+            for month in range(1, 13):
+                days = self.DAYS[month - 1] + (month == 2 and year != 1900)
+                monthly[year*100 + month] = float(days)
+        monthly[200402] = None      #a day is missing
+        self.check(rows, "IDCJAC0009", 1, monthly)
+        self.check(rows, "IDCJAC0009", 3, {1900: 365.0, 2000: 366.0, 2004: None})
+        february = [row for row in rows if row[3] == 2]
+        self.check(february, "IDCJAC0009", 2, {1900: 28.0, 2000: 29.0, 2004: None})
+        self.check(rows, "IDCJAC0009", 2, {1900: None, 2000: None, 2004: None})  #not one month
+        daily = dict([(row[2]*10000 + row[3]*100 + row[4], row[5]) for row in rows])
+        self.assertEqual(daily[20000301], 2.0)
+        self.assertNotIn(20000302, daily)
+        self.check(rows, "IDCJAC0009", 4, daily)
+
+    def test_temperature(self):
+        rows = handRows("IDCJAC0010", lambda year, month, day: float(day))
+        monthly = {}
+        for year in (1900, 2000, 2004):
+            for month in range(1, 13):
+                days = self.DAYS[month - 1] + (month == 2 and year != 1900)
+                monthly[year*100 + month] = (days + 1)/2.0
+        monthly[200402] = None
+        monthly[200003] = (1 + sum(range(3, 32)))/31.0     #1 March counts for two days
+        self.check(rows, "IDCJAC0010", 1, monthly)
+        self.check([row for row in rows if row[3] == 2], "IDCJAC0010", 2, {1900: 14.5, 2000: 15.0, 2004: None})
+
+def rowSet(data):
+    '''
+    The rows of openColumns' columns as sorted tuples, with the codes and flags as text
+    '''
+    rows = []
+    for i in range(weather.countRows(data)):
+        row = []
+        for name in weather.COLUMNS:
+            value = data[name][i].item()
+            if name in data["levels"]:
+                value = data["levels"][name][value]
+            elif value != value:
+                value = None    #nan
+            row.append(value)
+        rows.append(tuple(row))
+    return sorted(rows, key=repr)
+
+class ArchiveTest(unittest.TestCase):
+    def test_same_rows_as_filterData(self):
+        import shutil
+        import weather_archive
+        directory = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(directory, "rain.csv"), os.path.join(directory, "temp.csv")]
+            writeStations(paths[0], [70247, 66062], 14, missing=0.01, quality="YN")
+            writeStations(paths[1], [70247, 70072], 15, missing=0.01, code="IDCJAC0010", quality="YYN")
+            archive = os.path.join(directory, "archive")
+            weather_archive.writeArchive(paths, archive, chunkRows=500)
+            columns = [weather.openColumns(path, cache=False) for path in paths]
+            filters = [
+                [None]*8,
+                ["IDCJAC0009", 66062, None, None, None, None, None, None],
+                [None, 70072, None, None, None, None, None, None],
+                ["IDCJAC0010", None, None, 2, None, None, None, None],
+                [None, None, None, 12, None, None, None, "N"],
+                ["IDCJAC0009", 70247, 1993, 7, None, None, None, "Y"],
+                [None, None, None, None, None, None, None, "Y"],
+                [None, 99999, None, None, None, None, None, None],     #no row group has it
+                [None, None, 2050, None, None, None, None, None],
+                [None, None, None, None, None, None, None, "X"],
+                ["IDCJAC0010", 66062, None, None, None, None, None, None],
+            ]
+            for filt in filters:
+                expected = []
+                for data in columns:
+                    expected += rowSet(weather.filterData(data, filt))
+                archived = weather_archive.readArchive(archive, filt)
+                self.assertEqual(rowSet(archived), sorted(expected, key=repr), filt)
+                if filt[1] == 99999 or filt[2] == 2050:
+                    self.assertEqual(len(weather_archive.candidateChunks(archive, filt)), 0)
+            self.assertLess(len(weather_archive.candidateChunks(archive, filters[5])),
+                            len(weather_archive.candidateChunks(archive, filters[0])))
+        finally:
+            shutil.rmtree(directory)
+
+class InstrumentTest(unittest.TestCase):
+    def test_nested_peak(self):
+        weather_instrument.reset()
+        weather_instrument.enable(memory=True)
+        try:
+            largeStage()
+        finally:
+            weather_instrument.disable()
+        peaks = dict([(record["stage"], record["peakBytes"]) for record in weather_instrument.records()])
+        weather_instrument.reset()
+        self.assertGreater(peaks["testOuter"], 8000000)    #the list freed before the inner stage ran
+        self.assertLess(peaks["testInner"], 100000)
+
+def writeStations(path, stations, seed, missing=0.01, interleaved=False, code="IDCJAC0009", quality="Y"):
+    '''
+    Writes a rainfall (or with "code" IDCJAC0010, temperature) .csv file of 1990 to
+    1994 for each of "stations", with a "missing" fraction of the days left blank.
+    The stations follow each other, or with "interleaved" take turns day by day
+    Every row has the quality flag "quality", or a random one of its letters
+    '''
+    rng = random.Random(seed)
+    flags = random.Random(seed + 1)
+    lines = []
+    for station in stations:
+        lines.append([])
+        for year in range(1990, 1995):
+            for month in range(1, 13):
+                for day in range(1, weather._daysInMonth(year, month) + 1):
+                    if rng.random() < missing:
+                        value = ""
+                    elif code == "IDCJAC0009":
+                        value = "%.1f" % rng.expovariate(0.3)
+                    else:
+                        value = "%.1f" % rng.gauss(20, 6)
+                    lines[-1].append("%s,%06d,%d,%02d,%02d,%s,1,%s\n" % (code, station, year, month, day, value,
+                                                                           flags.choice(quality)))
+    with open(path, "w") as f:
+        f.write("Product code,Bureau of Meteorology station number,Year,Month,Day,"
+                "Rainfall amount (millimetres),Period over which rainfall was measured (days),Quality\n")
+        for line in (itertools.chain(*zip(*lines)) if interleaved else itertools.chain(*lines)):
+            f.write(line)
+
+class StationQueryTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        writeStations(self.path, [70247, 66062], 3)
+        self.data = weather.openColumns(self.path, cache=False)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_every_station_separately(self):
+        for stream in (False, True):
+            table = weather.runQuery(self.path, "IDCJAC0009", None, 1, 5, "high", stream=stream)
+            self.assertEqual(sorted(table), [66062, 70247])
+            for station in table:
+                self.assertEqual(table[station], weather.runQuery(self.path, "IDCJAC0009", station, 1, 5, "high"))
+
+    def test_interactive_season_every_station(self):
+        filt = ["IDCJAC0009", None, None, None, None, None, None, None]
+        answers = (filt, "high", 2, 2, self.path, 6, ["DJF"])
+        tables = []
+        with mock.patch.object(weather, "getInput", return_value=answers), \
+             mock.patch.object(weather, "outputResults", tables.append):
+            weather.interactiveQuery()
+        stations = weather.aggregateStations(self.data, "IDCJAC0009", 6, "DJF")
+        self.assertEqual(tables, [weather.stationThresholds(stations, 2, "high")])
+        self.assertEqual(sorted(tables[0]), [66062, 70247])
+        for station in tables[0]:
+            self.assertNotEqual(tables[0][station]["B"], None)
+
+    def test_no_merged_stations(self):
+        self.assertRaises(ValueError, weather.queryAggregate, self.data, "IDCJAC0009")
+        self.assertEqual(weather.queryStations(self.data, "IDCJAC0010"), {})
+
+def seasonTotals(rows, window):
+    '''
+    Option 6 worked out day by day: {year the season starts: total, or None unless
+    every day of that year's season has a value}, for (date, value) rows
+    '''
+    firstMonth, firstDay, lastMonth, lastDay = weather.seasonWindow(window)
+    crosses = (firstMonth, firstDay) > (lastMonth, lastDay)
+    values = {}
+    for date, value in rows:
+        day = (date.month, date.day)
+        if crosses and day >= (firstMonth, firstDay):
+            year = date.year
+        elif crosses and day <= (lastMonth, lastDay):
+            year = date.year - 1
+        elif not crosses and (firstMonth, firstDay) <= day <= (lastMonth, lastDay):
+            year = date.year
+        else:
+            continue
+        values.setdefault(year, {})[date] = value
+    totals = {}
+    for year, days in values.items():
+        try:
+            date = datetime.date(year, firstMonth, firstDay)
+        except ValueError:
+            date = datetime.date(year, 3, 1)     #29 February only counts in leap years
+        complete = True
+        total = 0.0
+        while (date.year, date.month, date.day) <= (year + crosses, lastMonth, lastDay):
+            if days.get(date) == None:
+                complete = False
+            else:
+                total += days[date]
+            date += datetime.timedelta(1)
+        totals[year] = total if complete else None
+    return totals
+
+class StreamAggregateTest(unittest.TestCase):
+    def test_same_as_in_memory(self):
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            for interleaved in (False, True):
+                writeStations(path, [70247, 66062, 70001], 6, missing=0.005, interleaved=interleaved)
+                data = weather.openColumns(path, cache=False)
+                for option, window in ((1, None), (2, None), (3, None), (4, None), (6, "DJF"), (6, "water")):
+                    for station, month in ((None, None), (66062, None), (None, 2), (70001, 12)):
+                        filt = ["IDCJAC0009", station, None, month, None, None, None, None]
+                        clean_data = weather.filterData(data, filt)
+                        for chunkRows in (50, None):
+                            self.assertEqual(weather.streamAggregate(path, filt, "IDCJAC0009", option, chunkRows, window, True),
+                                             weather.aggregateStations(clean_data, "IDCJAC0009", option, window))
+                            self.assertEqual(weather.streamAggregate(path, filt, "IDCJAC0009", option, chunkRows, window),
+                                             weather.aggregateData(clean_data, "IDCJAC0009", option, window))
+        finally:
+            os.remove(path)
+
+class CompoundTest(unittest.TestCase):
+    def test_joint_return_periods(self):
+        rng = random.Random(8)
+        for case in range(300):
+            n = rng.randint(1, 60)
+            x = [rng.randint(0, rng.choice([1, 3, 10])) for i in range(n)]
+            y = [rng.randint(0, rng.choice([1, 3, 10])) for i in range(n)]
+            for modeX in ("high", "low"):
+                for modeY in ("high", "low"):
+                    sign = dict(high=1, low=-1)
+                    expected = []
+                    for i in range(n):
+                        count = len([j for j in range(n) if sign[modeX]*x[j] >= sign[modeX]*x[i]
+                                     and sign[modeY]*y[j] >= sign[modeY]*y[i]])
+                        expected.append(n/count)
+                    self.assertEqual(weather.jointReturnPeriods(x, y, modeX, modeY).tolist(), expected)
+
+    def test_join(self):
+        rng = random.Random(9)
+        for case in range(200):
+            X = dict([(key, None if rng.random() < 0.2 else rng.random()) for key in rng.sample(range(60), rng.randint(0, 40))])
+            Y = dict([(key, None if rng.random() < 0.2 else rng.random()) for key in rng.sample(range(60), rng.randint(0, 40))])
+            keys = sorted([key for key in X if key in Y and X[key] != None and Y[key] != None])
+            joined = weather.joinAggregates(X, Y)
+            self.assertEqual([column.tolist() for column in joined],
+                             [keys, [X[key] for key in keys], [Y[key] for key in keys]])
+
+    def test_compound_events(self):
+        rng = random.Random(10)
+        rainfall = dict([(key, None if rng.random() < 0.1 else float(rng.randint(0, 30))) for key in range(120)])
+        temperature = dict([(key, float(rng.randint(10, 30))) for key in range(5, 130)])
+        result = weather.compoundEvents(rainfall, temperature, 10, 'low', 'high')
+        keys = [key for key in sorted(rainfall) if key in temperature and rainfall[key] != None]
+        self.assertEqual(result["keys"], keys)
+        thresholdX = weather.calcThresholdB(dict([(key, rainfall[key]) for key in keys]), 10, 'low')[0]
+        thresholdY = weather.calcThresholdB(dict([(key, temperature[key]) for key in keys]), 10, 'high')[0]
+        self.assertEqual(result["thresholds"], (thresholdX, thresholdY))
+        joint = [key for key in keys if rainfall[key] <= thresholdX and temperature[key] >= thresholdY]
+        self.assertEqual(result["jointCount"], len(joint))
+        periods = dict(zip(keys, result["returnPeriod"]))
+        self.assertEqual(sorted([event[0] for event in result["events"]]),
+                         [key for key in keys if periods[key] >= 10])
+        self.assertEqual([event[3] for event in result["events"]],
+                         sorted([event[3] for event in result["events"]], reverse=True))
+
+    def test_run_compound(self):
+        import shutil
+        import weather_archive
+        directory = tempfile.mkdtemp()
+        try:
+            rainfallPath = os.path.join(directory, "rain.csv")
+            temperaturePath = os.path.join(directory, "temp.csv")
+            archive = os.path.join(directory, "archive")
+            writeStations(rainfallPath, [70247, 66062], 11, missing=0.001)
+            writeStations(temperaturePath, [70247, 66062], 12, missing=0.001, code="IDCJAC0010")
+            weather_archive.writeArchive([rainfallPath, temperaturePath], archive)
+            rainfall = weather.queryAggregate(weather.openColumns(rainfallPath, cache=False), "IDCJAC0009", 66062, 1)
+            temperature = weather.queryAggregate(weather.openColumns(temperaturePath, cache=False), "IDCJAC0010", 66062, 1)
+            expected = weather.compoundEvents(rainfall, temperature, 5)
+            self.assertTrue(expected["events"])
+            with mock.patch.object(weather.weather_cache, "CACHE_DIR", os.path.join(directory, "cache")):
+                self.assertEqual(weather.runCompound(rainfallPath, temperaturePath, 66062, 1, 5), expected)
+                self.assertEqual(weather.runCompound(archive, archive, 66062, 1, 5), expected)
+                self.assertEqual(weather.runCompound(archive, temperaturePath, 66062, 1, 5), expected)
+        finally:
+            shutil.rmtree(directory)
+
+class BatchTest(unittest.TestCase):
+    def test_windows_shared(self):
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            writeStations(path, [70247, 66062], 13, missing=0.001)
+            jobs = [{"file": path, "product": "rain", "station": [66062, "all"], "option": [1, 5],
+                     "window": [None, 3, 7], "frequency": 10}]
+            queries = weather_batch.expandJobs(jobs)
+            self.assertEqual([(query["station"], query["option"], query["window"]) for query in queries],
+                             [(66062, 1, None), (66062, 5, None), (66062, 5, 3), (66062, 5, 7),
+                              (None, 1, None), (None, 5, None), (None, 5, 3), (None, 5, 7)])
+            weather_instrument.reset()
+            weather_instrument.enable()
+            try:
+                results = weather_batch.runBatch(queries)
+            finally:
+                weather_instrument.disable()
+            self.assertEqual(weather_instrument.summary()["dailySeries"]["calls"], 3)    #66062, then each station
+            weather_instrument.reset()
+            self.assertEqual([(row["station"], row["option"], row["window"]) for row in results if row["error"] == None],
+                             [(66062, 1, None), (66062, 5, 3), (66062, 5, 7), (66062, 1, None), (70247, 1, None),
+                              (66062, 5, 3), (70247, 5, 3), (66062, 5, 7), (70247, 5, 7)])
+            for row in results:
+                if row["error"] == None:
+                    expected = weather.runQuery(path, "IDCJAC0009", row["station"], row["option"], 10, "high",
+                                                window=row["window"])
+                    self.assertEqual(row["thresholdB"], expected["thresholdB"][0])
+                    self.assertEqual(row["aggregated"], expected["aggregated"])
+        finally:
+            os.remove(path)
+
+class SeasonTest(unittest.TestCase):
+    def test_windows(self):
+        self.assertEqual(weather.seasonWindow("djf"), (12, 1, 2, 29))
+        self.assertEqual(weather.seasonWindow("Water"), (7, 1, 6, 30))
+        self.assertEqual(weather.seasonWindow("11-15:02-29"), (11, 15, 2, 29))
+        self.assertEqual(weather.seasonWindow((2, 29, 3, 31)), (2, 29, 3, 31))
+        for window in ("02-30:03-31", "04-31:05-10", "06-01:09-31", "13-01:01-31", "00-01:01-31",
+                       "DJX", "12-01", 3, None, (1, 1, 2)):
+            self.assertRaises(ValueError, weather.seasonWindow, window)
+
+    def test_season_days(self):
+        self.assertEqual(weather._seasonDays("DJF", weather.np.array([1990, 1991, 1999, 2000])).tolist(),
+                         [90, 91, 91, 90])
+        self.assertEqual(weather._seasonDays("water", weather.np.array([1990, 1991])).tolist(), [365, 366])
+        self.assertEqual(weather._seasonDays("02-29:03-31", weather.np.array([1991, 1992])).tolist(), [31, 32])
+
+    def test_against_day_by_day(self):
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            writeStations(path, [70247], 5, missing=0.002)
+            data = weather.openColumns(path, cache=False)
+        finally:
+            os.remove(path)
+        rows = []
+        for year, month, day, value in zip(data["year"].tolist(), data["month"].tolist(),
+                                           data["day"].tolist(), data["measurement"].tolist()):
+            rows.append((datetime.date(year, month, day), None if value != value else value))
+        for window in ("DJF", "MAM", "water", "year", "11-15:02-29", "02-29:03-31", (12, 25, 1, 5)):
+            expected = seasonTotals(rows, window)
+            result = weather.aggregateData(data, "IDCJAC0009", 6, window)
+            self.assertEqual(sorted(result), sorted(expected), window)
+            self.assertTrue(any([value != None for value in expected.values()]), window)
+            for year in expected:
+                if expected[year] == None:
+                    self.assertEqual(result[year], None, (window, year))
+                else:
+                    self.assertAlmostEqual(result[year], expected[year], 6, (window, year))
+
+if __name__ == "__main__":
+    unittest.main()
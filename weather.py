@@ -1,7 +1,36 @@
+"""
+Finds how rare rainfall and temperature events are in Bureau of Meteorology data
+
+Run it to answer one query interactively, or import it and call runQuery and the
+functions below. Importing it has no side effects and loads no heavy libraries:
+NumPy is imported the first time a column or vectorized path uses it, and
+matplotlib only when a graph is drawn
+"""
 import os
-import sys
-import numpy as np
-import matplotlib.pyplot as mpl
+import math
+import random
+import bisect
+import importlib
+import itertools
+import collections
+import weather_cache
+import weather_instrument
+
+class _LazyModule:
+    """
+    Stands in for a module until one of its attributes is first used, then imports
+    it and takes its place in this module's globals, so later uses cost nothing extra
+    """
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attribute)
+
+np = _LazyModule("numpy", "np")
 
 #------INPUT FUNCTIONS------
 def getInput():
@@ -15,6 +44,8 @@ def getInput():
         4. aggI(int) - the aggregation column that should be used when manipulating the data
         5. filename(str) - path to the file to open containing the data to be processed
         6. option
+        7. windows(list) - the lengths in days of the rolling totals/averages for option 5,
+            the season for option 6 (see seasonWindow), otherwise None
      '''
 
     # Get filename from User
@@ -69,6 +100,8 @@ def getInput():
         print(" 2) - total the rainfall for a specific month, to produce a yearly timeseries, ")
         print(" 3) - total the rainfall for each year to produce a yearly timeseries")
         print(" 4) - Don't aggregate the data. I want a daily timeseries")
+        print(" 5) - total the rainfall over every run of N days (eg. 3-day or 5-day totals) to produce a daily timeseries")
+        print(" 6) - total the rainfall for a season or water year (eg. DJF or July to June) to produce a yearly timeseries")
         print()
 
     elif code == 'IDCJAC0010':
@@ -76,11 +109,14 @@ def getInput():
         print(" 2) - Find the average temperature for a specific month, to produce a yearly timeseries, ")
         print(" 3) - Find the average for each year to produce a yearly timeseries")
         print(" 4) - Don't aggregate the data. I want a daily timeseries")
+        print(" 5) - Find the average temperature over every run of N days to produce a daily timeseries")
+        print(" 6) - Find the average temperature for a season or water year (eg. DJF or July to June) to produce a yearly timeseries")
         print()
 
     while True:
         monthfilt = None    #if not set below, should be blank which is None
-        response10 = input("Please select which method you wish to use to aggregate the data (Enter '1', '2, '3', or '4'):")
+        windows = None
+        response10 = input("Please select which method you wish to use to aggregate the data (Enter '1', '2, '3', '4', '5' or '6'):")
         if int(response10) == 1:
             aggI = 3
             option = 1
@@ -109,8 +145,33 @@ def getInput():
             aggI = 4
             option = 4
             break
+        elif int(response10) == 5:
+            aggI = 4
+            option = 5
+            while True:
+                r = input("Over how many days? Several lengths can be separated by commas (eg. '3, 5, 7')")
+                try:
+                    windows = [int(x) for x in r.split(",")]
+                    if all([x > 0 for x in windows]):
+                        break
+                    print("Please enter whole numbers of days greater than 0")
+                except ValueError:
+                    print("Please enter whole numbers of days, separated by commas")
+            break
+        elif int(response10) == 6:
+            aggI = 2
+            option = 6
+            while True:
+                r = input("Which season? (Enter 'DJF', 'MAM', 'JJA', 'SON', 'Water' for July to June, or dates like '11-01:03-31')")
+                try:
+                    seasonWindow(r.strip())
+                    windows = [r.strip()]
+                    break
+                except ValueError as error:
+                    print(error)
+            break
         else:
-            print("Please enter an integer between 1 and 4")
+            print("Please enter an integer between 1 and 6")
 
 
 
@@ -153,8 +214,9 @@ def getInput():
 
     #filt = [code, station, None, months, None, None, None, quality]
     filt = [code, station, None, monthfilt, None, None, None, quality]
-    return filt, mode, frequency, aggI, filename, option
+    return filt, mode, frequency, aggI, filename, option, windows
 
+@weather_instrument.stage("openData")
 def openData(path):
     """
     Opens a .csv files that contains rainfall/temperature
@@ -202,7 +264,137 @@ def openData(path):
         data.append(newrow)
     return data
 
+#Column names of the BOM .csv files, in file order. "filt" lists use the same order
+COLUMNS = ["code", "station", "year", "month", "day", "measurement", "length", "quality"]
+CHUNK_ROWS = 1 << 18    #rows parsed at a time by openColumns
+
+#How each .csv line is read before it is packed into the compact columns.
+#Columns that may be blank are read as text and converted afterwards
+_CSV_DTYPE = [("code", "U16"), ("station", "i4"), ("year", "i2"), ("month", "i1"), ("day", "i1"),
+              ("measurement", "U16"), ("length", "U8"), ("quality", "U8")]
+#How the columns are stored once parsed
+_COLUMN_DTYPES = {"code": "i1", "station": "i4", "year": "i2", "month": "i1",
+                  "day": "i1", "measurement": "f8", "length": "i2", "quality": "i1"}
+
+@weather_instrument.stage("openColumns")
+def openColumns(path, cache=True):
+    """
+    Opens the same BOM .csv files as openData, but returns the data
+    column by column as a dictionary of NumPy arrays keyed by the names in COLUMNS:
+        code, quality - int8 indexes into data["levels"]["code"] / data["levels"]["quality"]
+        station (int32), year (int16), month (int8), day (int8)
+        measurement (float64) - nan where the file is blank
+        length (int16) - 0 where the file is blank
+    filterData and aggregateData accept this in place of openData's list of lists
+    Unless "cache" is False, parsed files are kept in weather_cache's on-disk cache
+    and later calls memory-map them (read-only) instead of parsing again
+    """
+
+    assert os.path.isfile(path), "The input file does not exist"
+
+    if cache:
+        return weather_cache.loadCached(path, _readColumns, "columns-1")
+    return _readColumns(path)
+
+def _readColumns(path):
+    """
+    Parses a BOM .csv file into openColumns' representation
+    """
+    levels = {"code": [], "quality": []}
+    chunks = list(streamColumns(path, levels=levels))
+
+    data = {"levels": levels}
+    for name in COLUMNS:
+        if chunks == []:
+            data[name] = np.zeros(0, _COLUMN_DTYPES[name])
+        else:
+            data[name] = np.concatenate([chunk[name] for chunk in chunks])
+    return data
+
+def streamColumns(path, filt=None, chunkRows=None, levels=None):
+    """
+    Reads a BOM .csv file "chunkRows" lines at a time (CHUNK_ROWS by default),
+    yielding each chunk in openColumns' representation
+    If "filt" is given (see filterData) only the rows that pass it are kept,
+    so memory never holds more than one chunk of the file
+    All chunks share one "levels" dictionary, which grows as new codes are read
+    """
+    assert os.path.isfile(path), "The input file does not exist"
+    if chunkRows == None:
+        chunkRows = CHUNK_ROWS
+    if levels == None:
+        levels = {"code": [], "quality": []}
+    f = open(path, "r")
+    try:
+        f.readline()    #skip first line
+        while True:
+            lines = list(itertools.islice(f, chunkRows))
+            if lines == []:
+                break
+            chunk = _parseColumns(lines, levels)
+            chunk["levels"] = levels
+            if filt != None:
+                chunk = _filterColumns(chunk, filt)
+            yield chunk
+    finally:
+        f.close()
+
+def _parseColumns(lines, levels):
+    """
+    Parses a list of .csv lines into a dictionary of compact columns (see openColumns)
+    New product codes and quality flags are appended to "levels"
+    """
+    rows = np.loadtxt(lines, delimiter=",", dtype=_CSV_DTYPE, ndmin=1)
+    measurement = rows["measurement"]
+    length = rows["length"]
+    columns = {
+        "code": _categorise(rows["code"], levels["code"]),
+        "station": rows["station"].copy(),
+        "year": rows["year"].copy(),
+        "month": rows["month"].copy(),
+        "day": rows["day"].copy(),
+        "measurement": np.where(measurement == "", "nan", measurement).astype(np.float64),
+        "length": np.where(length == "", "0", length).astype(np.int16),
+        "quality": _categorise(rows["quality"], levels["quality"]),
+    }
+    return columns
+
+def _categorise(values, levels):
+    """
+    Returns the int8 index of each string in "values" within "levels",
+    appending strings not seen before to "levels"
+    """
+    unique, inverse = np.unique(values, return_inverse=True)
+    index = []
+    for value in unique:
+        value = value.strip()
+        if value not in levels:
+            levels.append(value)
+        index.append(levels.index(value))
+    return np.array(index, dtype=np.int8)[inverse.reshape(-1)]
+
+def countRows(data):
+    """
+    Returns the number of rows in either openData's or openColumns' representation
+    """
+    if isinstance(data, dict):
+        return len(data["year"])
+    return len(data)
+
+def _columnRows(data):
+    """
+    Turns openColumns' representation back into openData's list of lists
+    """
+    code = [data["levels"]["code"][i] for i in data["code"].tolist()]
+    quality = [data["levels"]["quality"][i] for i in data["quality"].tolist()]
+    measurement = [None if value != value else value for value in data["measurement"].tolist()]
+    length = [None if value == 0 else value for value in data["length"].tolist()]
+    return [list(row) for row in zip(code, data["station"].tolist(), data["year"].tolist(),
+                                     data["month"].tolist(), data["day"].tolist(),
+                                     measurement, length, quality)]
+
 #------CALCULATION FUNCTIONS------
+@weather_instrument.stage("calcThresholdA")
 def calcThresholdA(X, F, mode):
     '''
     Accepts a dictionary X, an integer F and mode which is either 'high' or 'low'
@@ -213,55 +405,75 @@ def calcThresholdA(X, F, mode):
     For mode == 'low'
     Calculates the the largest value in a sequence such that every value smaller than
     or equal to this number appears on average every F position
+    Returns (threshold, [keys of X with that value]), or None if no value qualifies
     '''
-    index1 = 0
-    minimum = 1e9
-    threshold = []
     value_list = list(X.values())
     if type(F) != int:  #F is not an integer
         raise ValueError("F is must be an an integer")
     if mode != 'high' and mode != 'low': #invalid mode is entered
         raise ValueError("mode must be either 'high' or 'low'")
-    
+
+    #Replace missing data with values that are never extreme
     if mode == 'high':
-        for index in range(len(value_list)):  #Replace missing data with exceptionally low values
-            if value_list[index] == None:
-                value_list[index] = -1000
-        while index1 < len(value_list):
-            aboveXindex = [index for index in range(len(value_list)) if value_list[index] >= value_list[index1]]
-            for index in range(len(aboveXindex)-1):
-                difference = abs(aboveXindex[index+1]-aboveXindex[index])
-                if difference < minimum:
-                    minimum = difference
-            if minimum >= F:  #checks if the smallest difference is at least F
-                threshold.append(value_list[index1])
-            minimum = 1e9
-            index1 += 1
-    if mode == 'low':   #Works the same as when mode = high, except the inequalities are reversed
-        for index in range(len(value_list)):
-            if value_list[index] == None:
-                value_list[index] = 1000
-        while index1 < len(value_list):
-            belowXindex = [index for index in range(len(value_list)) if value_list[index] <= value_list[index1]]
-            for index in range(len(belowXindex)-1):
-                difference = abs(belowXindex[index+1]-belowXindex[index])
-                if difference < minimum:
-                    minimum = difference
-            if minimum >= F:
-                threshold.append(value_list[index1])
-            minimum = 1e9
-            index1 += 1
-    if len(threshold) != 0:
-        if mode == 'high':          #Returns smallest threshold for mode == 'high'
-            threshold_value = min(threshold)
-            key = [value for value in X if X[value] == threshold_value]
-            return threshold_value, key
-        if mode == 'low':           #Returns largest threhold for mode == 'low'
-            threshold_value = max(threshold)
-            key = [value for value in X if X[value] == threshold_value]
-            return threshold_value, key
-    print ('No values in the sequence, satisfy this condition')
+        value_list = [-1000 if value == None else value for value in value_list]
+    else:
+        value_list = [1000 if value == None else value for value in value_list]
+
+    #The smallest gap can only shrink as less extreme candidates are swept in,
+    #so the candidates that pass form a prefix of the sweep and the last one wins
+    threshold_value = None
+    candidates, gaps = _recurrenceGaps(value_list, mode)
+    for value, minimum in zip(candidates, gaps):
+        if minimum < F:
+            break
+        threshold_value = value
+    if threshold_value != None:
+        key = [value for value in X if X[value] == threshold_value]
+        return threshold_value, key
+    return None     #No values in the sequence satisfy this condition
+
+def _recurrenceGaps(value_list, mode):
+    '''
+    Sweeps the distinct values of value_list from the most extreme to the least
+    extreme (largest first for mode == 'high', smallest first for mode == 'low')
+    Returns two lists: the candidate values in sweep order, and for each one the
+    smallest gap between consecutive positions whose value is at least as extreme
+    (1e9 if there is only one such position)
+    Runs in O(n log n) - one sort, then linear passes
+    '''
+    n = len(value_list)
+    order = sorted(range(n), key=value_list.__getitem__, reverse=(mode == 'high'))
+
+    #Replay the sweep backwards as deletions from a linked list of every position.
+    #When a position is deleted its neighbours are the ones it had when the forward
+    #sweep inserted it, so each insertion only has to look at two gaps
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    left = [-1] * n
+    right = [n] * n
+    for index in reversed(order):
+        p, q = prev[index], nxt[index]
+        left[index], right[index] = p, q
+        if p >= 0:
+            nxt[p] = q
+        if q < n:
+            prev[q] = p
+
+    candidates = []
+    gaps = []
+    minimum = 1e9
+    for position, index in enumerate(order):
+        if left[index] >= 0 and index - left[index] < minimum:
+            minimum = index - left[index]
+        if right[index] < n and right[index] - index < minimum:
+            minimum = right[index] - index
+        #ties are swept in together before the candidate is recorded
+        if position == n - 1 or value_list[order[position + 1]] != value_list[index]:
+            candidates.append(value_list[index])
+            gaps.append(minimum)
+    return candidates, gaps
 
+@weather_instrument.stage("calcThresholdB")
 def calcThresholdB(X, F, mode):
     '''
     Accepts a dictionary X, an integer F and mode which is either 'high' or 'low'
@@ -285,17 +497,205 @@ def calcThresholdB(X, F, mode):
     #Make sure that the list "X" does not only contain None values
     assert values!=[], "There is no useable data for this aggregation"
 
-    quantile = len(values)//F
+    threshold = values[_quantileIndex(len(values), F, mode)]
+    key = [value for value in X if X[value] == threshold]
+    return threshold, key
+
+def _quantileIndex(n, F, mode):
+    '''
+    The index of calcThresholdB's threshold in "n" sorted values: the n//F-th
+    largest for mode == 'high' and the n//F-th smallest for mode == 'low', or
+    the smallest and the largest when n//F is 0
+    "n" may also be a NumPy array of counts, which gives an array of indexes
+    '''
+    quantile = n//F
     if mode == 'high':
-        threshold = values[-quantile]
-        key = [value for value in X if X[value] == threshold]
-        return threshold, key
+        return (n - quantile)*(quantile > 0)
+    return quantile - 1 + n*(quantile == 0)
+
+#The frequencies of a standard return-period curve
+RETURN_PERIODS = [2, 5, 10, 20, 50, 100]
+
+@weather_instrument.stage("thresholdCurve")
+def thresholdCurve(X, frequencies, mode):
+    '''
+    Accepts a dictionary X, a list of integer frequencies and mode which is either 'high' or 'low'
+    Returns the thresholds of both methods for every frequency at once, as
+    {F: {"A": calcThresholdA(X, F, mode), "B": calcThresholdB(X, F, mode)}, ...}
+    X is sorted and swept once: method B indexes the sorted values, and method A
+    looks each F up in the smallest recurrence gaps of every candidate
+    '''
+    assert type(X) == dict, "X must be a dictionary"
+    for F in frequencies:
+        if type(F) != int:  #F is not an integer
+            raise ValueError("F is must be an an integer")
+    if mode != 'high' and mode != 'low': #invalid mode is entered
+        raise ValueError("mode must be either 'high' or 'low'")
+
+    #every key of each value, in the order of X
+    keys = {}
+    for key, value in X.items():
+        keys.setdefault(value, []).append(key)
+
+    values = sorted([value for value in X.values() if value != None])
+    assert values!=[], "There is no useable data for this aggregation"
+
+    missing = -1000 if mode == 'high' else 1000
+    candidates, gaps = _recurrenceGaps([missing if value == None else value for value in X.values()], mode)
+    #the gaps never grow along the sweep, so the candidates that pass F are a prefix
+    descending = [-gap for gap in gaps]
+
+    curve = {}
+    for F in frequencies:
+        passed = bisect.bisect_right(descending, -F)
+        if passed == 0:
+            methodA = None
+        else:
+            methodA = (candidates[passed-1], keys.get(candidates[passed-1], []))
+        threshold = values[_quantileIndex(len(values), F, mode)]
+        curve[F] = {"A": methodA, "B": (threshold, keys[threshold])}
+    return curve
+
+BOOTSTRAP_BLOCK_BYTES = 1 << 26    #memory used by each block of resamples
+
+@weather_instrument.stage("bootstrapThresholds")
+def bootstrapThresholds(X, F, mode, resamples=2000, confidence=0.95, methodA=False, seed=0, workers=None):
+    '''
+    Accepts a dictionary X, an integer F and mode which is either 'high' or 'low'
+    Resamples X with replacement "resamples" times and returns a "confidence"
+    interval for the calcThresholdB threshold, and for calcThresholdA's too if "methodA":
+        {"B": {"threshold", "low", "high", "resamples"}, "A": the same or None}
+    "threshold" is the value for X itself, "low"/"high" are the percentile bounds
+    and "resamples" counts the resamples that had a threshold
+    Method B resamples the useable values; method A resamples the whole series,
+    missing values included, since it depends on where the values fall
+    Resamples are computed as 2-D arrays in blocks of at most BOOTSTRAP_BLOCK_BYTES.
+    Each block draws from its own stream spawned from "seed", so the result only
+    depends on the seed, and the blocks run on "workers" threads (every core by default)
+    '''
+    assert type(X) == dict, "X must be a dictionary"
+    if type(F) != int:  #F is not an integer
+        raise ValueError("F is must be an an integer")
+    if mode != 'high' and mode != 'low': #invalid mode is entered
+        raise ValueError("mode must be either 'high' or 'low'")
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be between 0 and 1")
+
+    values = np.array([value for value in X.values() if value != None], dtype=np.float64)
+    assert len(values) > 0, "There is no useable data for this aggregation"
+    missing = -1000 if mode == 'high' else 1000
+    series = np.array([missing if value == None else value for value in X.values()], dtype=np.float64)
     if mode == 'low':
-        threshold = values[quantile-1]
-        key = [value for value in X if X[value] == threshold]
-        return threshold, key
+        series = -series    #method A then always looks for a high
+
+    index = _quantileIndex(len(values), F, mode)
+
+    blockSize = max(1, BOOTSTRAP_BLOCK_BYTES//(16*len(series)))
+    blocks = [min(blockSize, resamples - start) for start in range(0, resamples, blockSize)]
+    streams = np.random.SeedSequence(seed).spawn(len(blocks))
+
+    def run(size, stream):
+        rng = np.random.default_rng(stream)
+        sample = values[rng.integers(0, len(values), (size, len(values)))]
+        statisticB = np.partition(sample, index, axis=1)[:, index]
+        statisticA = None
+        if methodA:
+            statisticA = _resampleThresholdA(series[rng.integers(0, len(series), (size, len(series)))], F)
+        return statisticB, statisticA
+
+    if workers == None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(blocks) > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(run, blocks, streams))
+    else:
+        outcomes = [run(size, stream) for size, stream in zip(blocks, streams)]
+
+    bounds = [(1 - confidence)/2, (1 + confidence)/2]
+    results = {"A": None, "B": None}
+    methods = [("B", calcThresholdB(X, F, mode), 0)]
+    if methodA:
+        methods.append(("A", calcThresholdA(X, F, mode), 1))
+    for method, estimate, position in methods:
+        statistic = np.concatenate([outcome[position] for outcome in outcomes])
+        if method == "A" and mode == 'low':
+            statistic = -statistic
+        statistic = statistic[~np.isnan(statistic)]
+        results[method] = {"threshold": None if estimate == None else estimate[0],
+                           "low": None, "high": None, "resamples": len(statistic)}
+        if len(statistic) > 0:
+            low, high = np.quantile(statistic, bounds).tolist()
+            results[method]["low"], results[method]["high"] = low, high
+    return results
+
+def _resampleThresholdA(samples, F):
+    '''
+    calcThresholdA of every row of "samples" for mode 'high' (nan where no value qualifies)
+    A value qualifies when no two positions fewer than F apart are both at least
+    as large, so the threshold is the smallest value above the largest
+    min(y[i], y[i+d]) over every gap d < F
+    '''
+    blocking = np.full(len(samples), -np.inf)
+    for gap in range(1, min(F, samples.shape[1])):
+        np.maximum(blocking, np.minimum(samples[:, gap:], samples[:, :-gap]).max(axis=1), out=blocking)
+    above = np.where(samples > blocking[:, None], samples, np.inf).min(axis=1)
+    return np.where(np.isinf(above), np.nan, above)
+
+@weather_instrument.stage("jointReturnPeriods")
+def jointReturnPeriods(x, y, modeX, modeY):
+    '''
+    Accepts two aligned sequences of values (see joinAggregates) and a mode for each,
+    'high' or 'low'
+    Returns a NumPy array of the empirical joint return period of every position:
+    n divided by the number of positions whose x and y are both at least as
+    extreme as its own, so the most extreme pair in both has the largest period
+    The counts take O(n log^2 n) vectorized steps: the distinct pairs are sorted by
+    x and then y, most extreme first, so every pair that counts towards one comes
+    before it, and a bottom-up merge counts the earlier pairs with a y at least as large
+    '''
+    for mode in (modeX, modeY):
+        if mode != 'high' and mode != 'low': #invalid mode is entered
+            raise ValueError("mode must be either 'high' or 'low'")
+    #flip the lows so that more extreme is always larger
+    x = np.asarray(x, dtype=np.float64)*(1 if modeX == 'high' else -1)
+    y = np.asarray(y, dtype=np.float64)*(1 if modeY == 'high' else -1)
+    n = len(x)
+    if n == 0:
+        return np.zeros(0)
+
+    #equal pairs count each other, so each distinct pair is counted once with its multiplicity
+    order = np.lexsort((-y, -x))
+    xs, ys = x[order], y[order]
+    first = np.concatenate([[True], (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])])
+    pair = np.cumsum(first) - 1
+    weight = np.bincount(pair)
+    rank = np.unique(ys[first], return_inverse=True)[1].reshape(-1)
+    m = len(weight)
+
+    counts = weight.copy()
+    position = np.arange(m)
+    size = 1
+    while size < m:
+        #each run of 2*size pairs: the second half counts the first half's pairs with y at least its own
+        block = position//(2*size)
+        left = (position//size)%2 == 0
+        leftKeys = block[left]*m + rank[left]
+        leftOrder = np.argsort(leftKeys, kind="stable")
+        leftKeys = leftKeys[leftOrder]
+        total = np.concatenate([[0], np.cumsum(weight[left][leftOrder])])
+        rightBlock = block[~left]
+        below = np.searchsorted(leftKeys, rightBlock*m + rank[~left], "left")
+        end = np.searchsorted(leftKeys, (rightBlock + 1)*m, "left")
+        counts[~left] += total[end] - total[below]
+        size *= 2
+
+    result = np.empty(n)
+    result[order] = n/counts[pair]
+    return result
 
 #------TOOLS------
+@weather_instrument.stage("filterData")
 def filterData(data, filt):
         """
         Returns a new list of items, but only items
@@ -306,6 +706,9 @@ def filterData(data, filt):
         row should be added to the new list
         """
 
+        if isinstance(data, dict):
+            return _filterColumns(data, filt)
+
         assert len(filt)==len(data[0]), "Incorrect filter length"
 
         newdata = []
@@ -323,168 +726,1155 @@ def filterData(data, filt):
 
         return newdata
 
-def aggregateData(data, dataType, option):
+def _filterColumns(data, filt):
+    """
+    filterData for openColumns' representation. Builds one boolean
+    mask from the "filt" entries that are not None and applies it to every column
+    """
+    assert len(filt)==len(COLUMNS), "Incorrect filter length"
+
+    levels = data["levels"]
+    passed = np.ones(len(data["year"]), dtype=bool)
+    for name, b in zip(COLUMNS, filt):
+        if b==None: #None is a blank filter
+            continue
+        if name in levels:
+            if b not in levels[name]:
+                passed[:] = False
+                break
+            b = levels[name].index(b)
+        passed &= data[name]==b
+
+    newdata = {"levels": levels}
+    for name in COLUMNS:
+        newdata[name] = data[name][passed]
+    return newdata
+
+@weather_instrument.stage("aggregateData")
+def aggregateData(data, dataType, option, window=None):
     """
     Returns a dictionary of {aggregation1: valueSum1, ...}
-    "aggI" is the column index to be used for aggregation
-    "valI" is the column of values to be grouped/summed
+    "data" is either openData's list of lists or openColumns' columns
     "dataType" is either "IDCJAC0009" or "IDCJAC0010"
-    This function groups all values in column index "valI"
-    together IF they have the same values in column index
-    "aggI"
-    Does not assume that aggregated data is in order
-    CURRENTLY - aggregations that include a "None" value
-    are given "None"
-
-    assume no observations on leap days
-    """
-    #print("aggI=", aggI, "valI=", valI, "data[0]=", data[0])
-    #assert 0<aggI<len(data[0]), "Impossible aggregation column number"
-    #assert 0<valI<len(data[0]), "Impossible value column number"
-    #assert type(data[0][valI])==int or type(data[0][valI])==float, "Can't aggregate non-integer/float values" - NOT TRUE IF FIRST OBSERVATON IS NONE
+    Rainfall (IDCJAC0009) is totalled over each aggregation,
+    temperature (IDCJAC0010) is averaged over its observation days
+    The aggregation keys are numbers in chronological order:
+        option 1 - year*100 + month
+        option 2, 3 - year
+        option 4 - year*10000 + month*100 + day
+        option 5 - year*10000 + month*100 + day of the last day of each
+            run of "window" days (see rollingData)
+        option 6 - the year each season "window" starts in (see seasonWindow),
+            eg. 1990 for December 1990 to February 1991
+    Aggregations that are missing observations are given "None"
+    """
     assert dataType=="IDCJAC0009" or dataType=="IDCJAC0010", "Incorrect data type"
-    assert 1<=option<=4, "Wrong option number. 'option' must be 1, 2, 3 or 4"
+    assert 1<=option<=6, "Wrong option number. 'option' must be 1, 2, 3, 4, 5 or 6"
+
+    if not isinstance(data, dict):
+        data = _rowColumns(data)
+    if option == 5:
+        return rollingData(dailySeries(data), dataType, window)
 
-    #print("Start aggregateData\naggI =", aggI, "dataType =", dataType, "option =", option)
+    keys, observationSum, observationDays, monthLow, monthHigh = _groupData(data, option, window=window)
+    return _finishGroups(keys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window)
 
+def _groupData(data, option, byStation=False, window=None):
+    """
+    Groups openColumns' columns by aggregation key (see aggregateData)
+    Returns arrays of the sorted keys, and for each key the sum of its observations,
+    the number of days they cover, and the smallest and largest month seen
+    With "byStation" every station is grouped separately, under the keys
+    station*STATION_KEY + aggregation key
+    """
     #GROUP/AGGREGATE ALL OF THE DATA
-    #Group like this: {agg: a list of "data" rows,...}
-    grouped = {}
-    for row in data:
-        if option == 1:
-            aggregation = int( str(row[2]) + str(row[3]) )  #ints compute fast
-        elif option==2 or option==3:
-            aggregation = row[2]
-        else:# option == 4
-            aggregation = int(str(row[2])+str(row[3])+str(row[4]))
-
-        if aggregation in grouped:
-            grouped[aggregation].append(row)
-        else:
-            grouped[aggregation] = [row]
+    #Every row gets a numeric key, and the sums are grouped reductions over those keys
+    keys = _groupKeys(data, option, window)
+    if option == 6:
+        inSeason = keys >= 0
+        data, keys = _filterRows(data, inSeason), keys[inSeason]
+    if byStation:
+        keys = keys + data["station"].astype(np.int64)*STATION_KEY
+    keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    groups = len(keys)
+    valid = ~np.isnan(data["measurement"])
+    observationSum = np.bincount(inverse, weights=np.where(valid, data["measurement"], 0.0), minlength=groups)
+    #a blank length means the observation covers a single day
+    length = np.where(data["length"]==0, 1, data["length"])
+    observationDays = np.bincount(inverse, weights=np.where(valid, length, 0), minlength=groups)
+    monthLow = np.full(groups, 13, dtype=np.int8)
+    monthHigh = np.zeros(groups, dtype=np.int8)
+    np.minimum.at(monthLow, inverse, data["month"])
+    np.maximum.at(monthHigh, inverse, data["month"])
+    return keys, observationSum, observationDays, monthLow, monthHigh
+
+#Per-station keys are station*STATION_KEY + aggregation key (at most 99991231)
+STATION_KEY = 10**8
+
+@weather_instrument.stage("aggregateStations")
+def aggregateStations(data, dataType, option, window=None):
+    """
+    Aggregates every station of "data" separately, in one pass over it
+    Returns {station: aggregateData(that station's rows, dataType, option, window), ...}
+    in station order
+    """
+    assert dataType=="IDCJAC0009" or dataType=="IDCJAC0010", "Incorrect data type"
+    assert 1<=option<=6, "Wrong option number. 'option' must be 1, 2, 3, 4, 5 or 6"
+
+    if not isinstance(data, dict):
+        data = _rowColumns(data)
+    if option == 5:
+        #rolling runs need each station's own calendar
+        results = {}
+        for station in np.unique(data["station"]).tolist():
+            results[station] = rollingData(dailySeries(_filterColumns(data, [None, station] + [None]*6)), dataType, window)
+        return results
+
+    keys, observationSum, observationDays, monthLow, monthHigh = _groupData(data, option, True, window)
+    return _finishStations(keys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window)
+
+def _finishStations(keys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window=None):
+    """
+    Turns grouped reductions under per-station keys into aggregateStations' result
+    """
+    groupKeys = keys%STATION_KEY
+    values, useable = _groupValues(groupKeys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window)
+    results = {}
+    for station, group, value, ok in zip((keys//STATION_KEY).tolist(), groupKeys.tolist(), values.tolist(), useable.tolist()):
+        if station not in results:
+            results[station] = {}
+        results[station][group] = value if ok else None
+    return results
+
+@weather_instrument.stage("stationThresholds")
+def stationThresholds(stations, F, mode):
+    '''
+    Accepts a dictionary of {station: aggregated data} from aggregateStations, an integer F
+    and mode which is either 'high' or 'low'
+    Returns a table of {station: {"A": calcThresholdA(X, F, mode), "B": calcThresholdB(X, F, mode)}}
+    Method B is found for every station at once: all values are sorted by station
+    and value together, and each station's quantile is indexed in its own run
+    Stations without useable data get None for both methods
+    '''
+    if type(F) != int:  #F is not an integer
+        raise ValueError("F is must be an an integer")
+    if mode != 'high' and mode != 'low': #invalid mode is entered
+        raise ValueError("mode must be either 'high' or 'low'")
+
+    owners = []
+    values = []
+    for station, X in stations.items():
+        for value in X.values():
+            if value != None:
+                owners.append(station)
+                values.append(value)
+    owners = np.array(owners, dtype=np.int64)
+    values = np.array(values, dtype=np.float64)
+    order = np.lexsort((values, owners))
+    owners, values = owners[order], values[order]
+    withData, starts, counts = np.unique(owners, return_index=True, return_counts=True)
+    index = starts + _quantileIndex(counts, F, mode)
+    methodB = dict(zip(withData.tolist(), values[index].tolist()))
+
+    table = {}
+    for station, X in stations.items():
+        table[station] = {"A": None, "B": None}
+        if station in methodB:
+            threshold = methodB[station]
+            table[station]["A"] = calcThresholdA(X, F, mode)
+            table[station]["B"] = (threshold, [key for key in X if X[key] == threshold])
+    return table
+
+@weather_instrument.stage("streamAggregate")
+def streamAggregate(path, filt, dataType, option, chunkRows=None, window=None, byStation=False):
+    """
+    Gives the same result as aggregateData(filterData(openData(path), filt), dataType, option)
+    without holding the file in memory: the file is read and filtered in chunks
+    (see streamColumns) and each chunk is added to running per-group sums,
+    so memory grows with the number of groups rather than the number of rows
+    With "byStation" every station is aggregated separately, as aggregateStations does
+    Supports options 1 to 4 and 6
+    """
+    assert dataType=="IDCJAC0009" or dataType=="IDCJAC0010", "Incorrect data type"
+    assert option in (1, 2, 3, 4, 6), "Wrong option number. 'option' must be 1, 2, 3, 4 or 6"
+
+    groups = _RunningGroups()
+    for chunk in streamColumns(path, filt, chunkRows):
+        keys = _groupKeys(chunk, option, window)
+        if option == 6:
+            chunk, keys = _filterRows(chunk, keys >= 0), keys[keys >= 0]
+        if byStation:
+            keys = keys + chunk["station"].astype(np.int64)*STATION_KEY
+        groups.add(keys, chunk)
+    return groups.finish(dataType, option, window, byStation)
+
+class _RunningGroups:
+    """
+    The grouped reductions of _groupData, accumulated one chunk of rows at a time
+    Every observation is added to its group's sums in row order, exactly as
+    _groupData's bincounts do, so the results are identical
+    The arrays have spare room at the end. Groups that come after every group seen
+    so far (the usual case for a file in date order) are appended there, and only
+    a chunk's keys up to the last group seen are looked up among the earlier groups
+    """
+    EMPTY = (("observationSum", 0.0), ("observationDays", 0.0), ("monthLow", 13), ("monthHigh", 0))
+
+    def __init__(self):
+        self.size = 0                               #groups in use, at the start of each array
+        self.keys = np.zeros(0, dtype=np.int64)     #sorted
+        self.observationSum = np.zeros(0)
+        self.observationDays = np.zeros(0)
+        self.monthLow = np.zeros(0, dtype=np.int8)
+        self.monthHigh = np.zeros(0, dtype=np.int8)
+
+    def add(self, keys, data):
+        """
+        Adds rows of openColumns' representation with their aggregation keys
+        """
+        if len(keys) == 0:
+            return
+        keys = np.asarray(keys, dtype=np.int64)
+        last = self.keys[self.size - 1] if self.size else None
+        seen = np.zeros(len(keys), dtype=bool) if last == None else keys <= last
+        if seen.any():
+            slot = np.searchsorted(self.keys[:self.size], keys[seen])
+            missing = self.keys[slot] != keys[seen]
+            if missing.any():
+                self._insert(np.unique(keys[seen][missing]))
+        if not seen.all():
+            self._append(np.unique(keys[~seen]))
+        slot = np.searchsorted(self.keys[:self.size], keys)
+        valid = ~np.isnan(data["measurement"])
+        #a blank length means the observation covers a single day
+        length = np.where(data["length"]==0, 1, data["length"])
+        np.add.at(self.observationSum, slot, np.where(valid, data["measurement"], 0.0))
+        np.add.at(self.observationDays, slot, np.where(valid, length, 0))
+        np.minimum.at(self.monthLow, slot, data["month"])
+        np.maximum.at(self.monthHigh, slot, data["month"])
+
+    def finish(self, dataType, option, window=None, byStation=False):
+        """
+        aggregateData's dictionary for every row added so far, or aggregateStations'
+        if the keys were per-station keys
+        """
+        finish = _finishStations if byStation else _finishGroups
+        size = self.size
+        return finish(self.keys[:size], self.observationSum[:size], self.observationDays[:size],
+                      self.monthLow[:size], self.monthHigh[:size], dataType, option, window)
+
+    def _append(self, new):
+        """
+        Adds sorted keys that all come after the last group
+        """
+        size = self.size + len(new)
+        if size > len(self.keys):
+            capacity = max(size, 2*len(self.keys))
+            self.keys = self._resized(self.keys, capacity, 0)
+            for name, empty in self.EMPTY:
+                setattr(self, name, self._resized(getattr(self, name), capacity, empty))
+        self.keys[self.size:size] = new
+        self.size = size
+
+    def _insert(self, new):
+        """
+        Adds sorted keys that fall between the groups already there, rebuilding the arrays
+        """
+        used = self.keys[:self.size]
+        keys = np.union1d(used, new)
+        old = np.searchsorted(keys, used)
+        for name, empty in self.EMPTY:
+            column = getattr(self, name)
+            grown = np.full(len(keys), empty, dtype=column.dtype)
+            grown[old] = column[:self.size]
+            setattr(self, name, grown)
+        self.keys = keys
+        self.size = len(keys)
+
+    @staticmethod
+    def _resized(column, capacity, empty):
+        grown = np.full(capacity, empty, dtype=column.dtype)
+        grown[:len(column)] = column
+        return grown
 
+def _groupKeys(data, option, window=None):
+    """
+    Returns the aggregation key of every row of openColumns' columns (see aggregateData)
+    """
+    year = data["year"].astype(np.int64)
+    if option == 1:
+        return year*100 + data["month"]
+    elif option==2 or option==3:
+        return year
+    elif option == 6:
+        #rows outside the season get key -1, for the caller to drop
+        shift = _seasonIndex(window)[data["month"], data["day"]]
+        return np.where(shift < 0, -1, year - shift)
+    else:# option == 4
+        return year*10000 + data["month"].astype(np.int64)*100 + data["day"]
+
+def _finishGroups(keys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window=None):
+    """
+    Turns the grouped reductions of aggregateData into its result dictionary
+    "monthLow"/"monthHigh" are the smallest and largest month seen in each group
+    """
+    values, useable = _groupValues(keys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window)
+    results = {}
+    for group, value, ok in zip(keys.tolist(), values.tolist(), useable.tolist()):
+        results[group] = value if ok else None
+    return results
+
+def _groupValues(keys, observationSum, observationDays, monthLow, monthHigh, dataType, option, window=None):
+    """
+    Returns the total/average of each group, and whether the group is complete enough to use
+    """
     #CHECK IF THE AGGREGATION IS USEABLE AND SUM
     #   OPTION  #DESCRIPTION                        AGGREGATION aggI    OBS. CONDITION              REQUIRED # of OBS
     #   1       Sum months seperately               Monthly     3       Observations in same month  Same # of obs. as days in the particular month
     #   2       Sum a specific month for each year  Yearly      2       Observations in same month  Same # of obs. as days in the particular month
     #   3       Sum each year                       Yearly      2       Observations in same year   365/366 observations per group
-    #   4       No aggregation, return each obs     Daliy       4       None                        None
+    #   4       No aggregation, return each obs     Daliy       4       None                        At least one observation
+    #   6       Sum each season/water year          Yearly      -       Observations in same season Every day of that year's season
+    if option == 1:
+        year, month = keys//100, keys%100
+        useable = observationDays == _daysInMonth(year, month)
+    elif option == 2:
+        sameMonth = monthLow == monthHigh
+        useable = sameMonth & (observationDays == _daysInMonth(keys, np.where(sameMonth, monthLow, 1)))
+    elif option == 3:
+        useable = observationDays == 365 + _isLeapYear(keys)
+    elif option == 6:
+        useable = observationDays == _seasonDays(window, keys)
+    else:
+        useable = observationDays > 0
 
+    if dataType == "IDCJAC0009":
+        values = observationSum
+    else:
+        values = observationSum/np.where(useable, observationDays, 1)
+    return values, useable
+
+@weather_instrument.stage("dailySeries")
+def dailySeries(data):
+    """
+    Lays the observations of openColumns' columns out on a calendar with one
+    entry per day from the first to the last observation, ready for rollingData
+    Multi-day observations (column 6, "length") cover the days up to and including
+    the day they are recorded on. Returns a dictionary of arrays:
+        day - the date of each calendar day, as days since 1970-01-01
+        total - running total of the observations recorded up to each day (long double)
+        covered - running count of days covered by exactly one observation
+        starts - whether an observation period starts on the day
+        ends - whether an observation period ends on the day
+    The running totals/counts have a leading 0, so sums over days s..e are x[e+1] - x[s]
+    """
+    if not isinstance(data, dict):
+        data = _rowColumns(data)
+
+    valid = ~np.isnan(data["measurement"])
+    dayNumber = _dayNumbers(data["year"], data["month"], data["day"])
+    if len(dayNumber) == 0:
+        first, days = 0, 0
+    else:
+        first = dayNumber.min()
+        days = int(dayNumber.max() - first + 1)
+
+    end = dayNumber[valid] - first
+    start = end - np.where(data["length"][valid]==0, 1, data["length"][valid]) + 1
+    coverage = np.bincount(np.clip(start, 0, None), minlength=days+1) - np.bincount(end + 1, minlength=days+1)
+    covered = np.cumsum(coverage[:days]) == 1
+
+    series = {
+        "day": np.arange(first, first + days, dtype=np.int64),
+        "total": np.concatenate([[0.0], np.cumsum(np.bincount(end, weights=data["measurement"][valid], minlength=days), dtype=np.longdouble)]),
+        "covered": np.concatenate([[0], np.cumsum(covered)]),
+        "starts": np.bincount(start[start >= 0], minlength=days).astype(bool),
+        "ends": np.bincount(end, minlength=days).astype(bool),
+    }
+    return series
+
+@weather_instrument.stage("rollingData")
+def rollingData(series, dataType, window):
+    """
+    Returns a dictionary of {day: value, ...} with the rainfall total (IDCJAC0009)
+    or average temperature (IDCJAC0010) over every run of "window" days, keyed
+    by the last day of the run as year*10000 + month*100 + day
+    "series" comes from dailySeries, so several window lengths can reuse it
+    A run is given "None" unless its days are covered by observations that lie
+    wholly inside it, with no day missing or observed twice
+    """
+    assert dataType=="IDCJAC0009" or dataType=="IDCJAC0010", "Incorrect data type"
+    assert type(window)==int and window > 0, "window must be a whole number of days"
+
+    days = len(series["day"])
+    if days < window:
+        return {}
+    last = np.arange(window - 1, days)     #the last day of each run
+    first = last - window + 1
+    #the running total is kept in extended precision so that differences of it round like direct sums
+    values = (series["total"][last + 1] - series["total"][first]).astype(np.float64)
+    useable = (series["covered"][last + 1] - series["covered"][first] == window) & series["starts"][first] & series["ends"][last]
+    if dataType == "IDCJAC0010":
+        values = values/window
+
+    keys = _dayKeys(series["day"][last])
     results = {}
-    daysEachMonth = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    #daysEachYear = depends on year
-    for group in grouped:
-
-        items = grouped[group]  #these are "data" rows
-
-        #Get number of observation days and the sum of observations
-        observationDays = 0 #no. of observation days for a group/aggregation
-        observationSum = 0  #sum of observations for a group (ignores Nones)
-        for item in items:
-            if item[5]!=None:
-                observationSum += item[5]
-                if item[6]==None:   #Observation of 0 gets None here
-                    observationDays += 1
-                else:
-                    observationDays += item[6]
-
-        #print("Group:", group, "observationDays=", observationDays, "observationSum=", observationSum)
-
-        #-----CHECK IF THE AGGREGATION IS USEABLE-----
-        #Check that the observation condition is satisfied
-        if option==1 or option==2:
-            #Check all observations in this group are in the same month
-            months = [x[3] for x in items]
-            obsCondCheck = all([x==months[0] for x in months])
-        elif option==3:
-            #Option 3. Check all observations in this group are in the same year
-            years = [x[2] for x in items]
-            obsCondCheck = all([x==years[0] for x in years])
-        else:
-            #there is no condition
-            obsCondCheck = True
-
-        #Check that there are the required number of observations
-        if option==1 or option==2:
-            #Same # of obs as days in the specific month
-            month = items[0][3] #all the same month in this case
-            requiredNo = daysEachMonth[month-1]
-            requiredNoCheck = observationDays==requiredNo
-        elif option==3:
-            ## observations=# of days in the current year
-            year = items[0][2]  #all the same year in this case
-            if year%4==0:
-                requiredNo = 366    #leap year
-            else:
-                requiredNo = 365
-            requiredNoCheck = observationDays==requiredNo
+    for key, value, ok in zip(keys.tolist(), values.tolist(), useable.tolist()):
+        results[key] = value if ok else None
+    return results
+
+def _dayNumbers(year, month, day):
+    """
+    Days since 1970-01-01 of each date, element by element
+    """
+    months = (np.asarray(year, dtype=np.int64) - 1970)*12 + np.asarray(month, dtype=np.int64) - 1
+    return months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + np.asarray(day, dtype=np.int64) - 1
+
+def _dayKeys(dayNumber):
+    """
+    Inverse of _dayNumbers, as year*10000 + month*100 + day keys
+    """
+    date = np.asarray(dayNumber, dtype=np.int64).astype("datetime64[D]")
+    months = date.astype("datetime64[M]")
+    year = months.astype(np.int64)//12 + 1970
+    month = months.astype(np.int64)%12 + 1
+    day = (date - months.astype("datetime64[D]")).astype(np.int64) + 1
+    return year*10000 + month*100 + day
+
+def _isLeapYear(year):
+    """
+    Gregorian leap years, element by element
+    """
+    return (year%4==0) & ((year%100!=0) | (year%400==0))
+
+def _daysInMonth(year, month):
+    """
+    Number of days in each month of each year, element by element
+    """
+    daysEachMonth = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    return daysEachMonth[np.asarray(month)-1] + ((month==2) & _isLeapYear(year))
+
+#Named windows for option 6, as (first month, first day, last month, last day)
+SEASONS = {
+    "DJF": (12, 1, 2, 29), "MAM": (3, 1, 5, 31), "JJA": (6, 1, 8, 31), "SON": (9, 1, 11, 30),
+    "water": (7, 1, 6, 30),     #the water year, July to June
+    "year": (1, 1, 12, 31),
+}
+
+def seasonWindow(window):
+    """
+    Returns the (first month, first day, last month, last day) of an option 6 window,
+    which is a name from SEASONS, a "MM-DD:MM-DD" string or such a tuple
+    Both ends are included, and a window whose last day comes before its first day
+    in the calendar runs into the next year. Days that don't exist every year
+    (eg. 29 February) are only counted in the years they exist
+    """
+    names = dict([(name.lower(), name) for name in SEASONS])
+    if isinstance(window, str) and window.lower() in names:
+        window = SEASONS[names[window.lower()]]
+    elif isinstance(window, str):
+        try:
+            first, last = window.split(":")
+            window = tuple([int(x) for x in first.split("-") + last.split("-")])
+        except ValueError:
+            raise ValueError("A window must be one of " + ", ".join(SEASONS) + " or 'MM-DD:MM-DD'")
+    if not isinstance(window, (tuple, list)) or len(window) != 4:
+        raise ValueError("A window must be one of " + ", ".join(SEASONS) + " or 'MM-DD:MM-DD'")
+    firstMonth, firstDay, lastMonth, lastDay = [int(x) for x in window]
+    if not (1 <= firstMonth <= 12 and 1 <= lastMonth <= 12 and 1 <= firstDay <= 31 and 1 <= lastDay <= 31):
+        raise ValueError("Invalid window: " + str(window))
+    for month, day in ((firstMonth, firstDay), (lastMonth, lastDay)):
+        if day > int(_daysInMonth(2000, month)):     #2000 is a leap year, so 29 February is allowed
+            raise ValueError("Invalid window: " + str(window) + " - %02d-%02d is not a date" % (month, day))
+    return firstMonth, firstDay, lastMonth, lastDay
+
+def _seasonIndex(window):
+    """
+    A [month, day] table for an option 6 window: -1 for days outside it, otherwise
+    how many years after the window's first day the day falls (0, or 1 past New Year)
+    """
+    firstMonth, firstDay, lastMonth, lastDay = seasonWindow(window)
+    month, day = np.meshgrid(np.arange(13), np.arange(32), indexing="ij")
+    date = month*100 + day
+    first = firstMonth*100 + firstDay
+    last = lastMonth*100 + lastDay
+    if first <= last:
+        index = np.where((first <= date) & (date <= last), 0, -1)
+    else:
+        index = np.where(date >= first, 0, np.where(date <= last, 1, -1))
+    return index.astype(np.int64)
+
+def _seasonDays(window, year):
+    """
+    Number of days in the option 6 window that starts in each "year", from the calendar
+    """
+    firstMonth, firstDay, lastMonth, lastDay = seasonWindow(window)
+    year = np.asarray(year, dtype=np.int64)
+    lastYear = year + (firstMonth*100 + firstDay > lastMonth*100 + lastDay)
+    #a first day past the end of its month (eg. 29 February) falls into the next month
+    first = _dayNumbers(year, firstMonth, firstDay)
+    last = _dayNumbers(lastYear, lastMonth, np.minimum(lastDay, _daysInMonth(lastYear, lastMonth)))
+    return last - first + 1
+
+def _rowColumns(data):
+    """
+    Turns openData's list of lists into openColumns' representation
+    """
+    levels = {"code": [], "quality": []}
+    columns = {"levels": levels}
+    for i, name in enumerate(COLUMNS):
+        column = [row[i] for row in data]
+        if name in levels:
+            columns[name] = _categorise(np.array(column, dtype=str), levels[name])
+        elif name == "measurement":
+            columns[name] = np.array([np.nan if x==None else x for x in column], dtype=np.float64)
         else:
-            #there is no condition
-            requiredNoCheck = True
+            columns[name] = np.array([0 if x==None else x for x in column], dtype=_COLUMN_DTYPES[name])
+    return columns
+
+#------INCREMENTAL FUNCTIONS------
+class IncrementalAggregate:
+    '''
+    Keeps the state of aggregateData and both threshold calculations for one
+    query, so that new observations can be appended without going over the whole
+    history again. Rows are appended with append() in the same forms aggregateData
+    accepts, and the results stay equal to recalculating from scratch:
+        aggregated - aggregateData's dictionary for every row seen so far
+        thresholdA(), thresholdB() - calcThresholdA/calcThresholdB of "aggregated"
+    Appended rows only update their own groups. While rows arrive in date order
+    (only the newest group changes or a newer one starts) both thresholds are
+    refreshed in O(log n) time; a change to an older group makes thresholdA
+    rebuild its state in O(n) once
+    Options 1 to 4 are supported
+    '''
+    def __init__(self, dataType, option, frequency, mode, data=None):
+        assert dataType=="IDCJAC0009" or dataType=="IDCJAC0010", "Incorrect data type"
+        assert 1<=option<=4, "Wrong option number. 'option' must be 1, 2, 3 or 4"
+        if type(frequency) != int:  #F is not an integer
+            raise ValueError("F is must be an an integer")
+        if mode != 'high' and mode != 'low': #invalid mode is entered
+            raise ValueError("mode must be either 'high' or 'low'")
+        self.dataType = dataType
+        self.option = option
+        self.frequency = frequency
+        self.mode = mode
+        self.aggregated = {}    #in key order, like aggregateData
+        self._groups = {}       #key -> [observationSum, observationDays, monthLow, monthHigh]
+        self._keys = {}         #value -> keys of "aggregated" with that value
+        self._values = _SortedValues()      #the values calcThresholdB ranks
+        self._rebuild(data)
+
+    def append(self, data):
+        '''
+        Adds rows of openData's or openColumns' form to the aggregation
+        '''
+        if isinstance(data, dict):
+            data = _columnRows(data)
+        for row in data:
+            key = _groupKeys(_rowColumns([row]), self.option).item()
+            group = self._groups.get(key)
+            if group == None:
+                group = self._groups[key] = [0, 0, 13, 0]
+                if self.aggregated and key < next(reversed(self.aggregated)):
+                    #an older group has started - put it in key order
+                    self._rebuild(None)
+            if row[5] != None:
+                group[0] += row[5]
+                group[1] += 1 if row[6] == None else row[6]
+            group[2] = min(group[2], row[3])
+            group[3] = max(group[3], row[3])
+            self._update(key)
+
+    def thresholdA(self):
+        '''
+        calcThresholdA of the aggregated data
+        '''
+        #With y the sequence of values (negated for mode 'low'), a candidate fails
+        #exactly when two positions less than F apart both reach it, so the
+        #threshold is the smallest y above M = the largest min(y[i], y[j]) over such pairs
+        M = max(self._prefixM, self._lastM())
+        rank = self._sequence.bisectRight(M)
+        if rank == len(self._sequence):
+            return None
+        threshold = self._sequence[rank]
+        if self.mode == 'low':
+            threshold = -threshold
+        return threshold, sorted(self._keys.get(threshold, []))
 
-        #----------------------------------------------
+    def thresholdB(self):
+        '''
+        calcThresholdB of the aggregated data, or None if there is no useable data
+        '''
+        n = len(self._values)
+        if n == 0:
+            return None
+        threshold = self._values[_quantileIndex(n, self.frequency, self.mode)]
+        return threshold, sorted(self._keys.get(threshold, []))
 
-        #print("- obsCondCheck=", obsCondCheck, "requiredNoCheck=", requiredNoCheck)
+    def _update(self, key):
+        '''
+        Recomputes the value of one group and updates every structure that holds it
+        '''
+        observationSum, observationDays, monthLow, monthHigh = self._groups[key]
+        value = _finishGroups(np.array([key]), np.array([observationSum], dtype=np.float64),
+                              np.array([observationDays], dtype=np.float64), np.array([monthLow]),
+                              np.array([monthHigh]), self.dataType, self.option)[key]
+        old = self.aggregated.get(key)
+        new = key not in self.aggregated
+        if not new and old == value and (old == None) == (value == None):
+            return
+        if not new:
+            self._discard(key, old)
+        self.aggregated[key] = value
+        if value != None:
+            self._keys.setdefault(value, []).append(key)
+            self._values.insert(value)
 
-        if not (obsCondCheck and requiredNoCheck):
-            results[group] = None
+        y = self._sequenceValue(value)
+        if new:
+            self._commitLast()
+            self._sequence.insert(y)
+            self._y.append(y)
+        elif key == next(reversed(self.aggregated)):
+            self._sequence.remove(self._y[-1])
+            self._sequence.insert(y)
+            self._y[-1] = y
         else:
-            if dataType == "IDCJAC0009":
-                results[group] = observationSum
-            else:
-                results[group] = observationSum/observationDays
+            self._rebuild(None)
 
-        """
+    def _discard(self, key, value):
+        if value != None:
+            self._keys[value].remove(key)
+            if self._keys[value] == []:
+                del self._keys[value]
+            self._values.remove(value)
 
-            #Get input will only ever output aggregation indexes of 2 or 3 (y or m)
-            #If 3, months will be grouped. This h
-            if aggI==3: #monthly aggregation
-                month = items[0][4] #get the month (all are the same)
-                correctNoOfObs = daysEachMonth[month-1]
-                elif aggI==2:   #yearly aggregation
-                correctNoOfObs = daysEachYear
-            else:
-                print("I dont know what to do here...! aggI=", aggI)
+    def _sequenceValue(self, value):
+        #Missing data is never extreme, as in calcThresholdA
+        if value == None:
+            return -1000
+        return value if self.mode == 'high' else -value
+
+    def _commitLast(self):
+        '''
+        Moves the newest position into the committed prefix before a new one starts
+        '''
+        if self._y == []:
+            return
+        self._prefixM = max(self._prefixM, self._lastM())
+        position = len(self._y) - 1
+        while self._window and self._window[-1][1] <= self._y[-1]:
+            self._window.pop()
+        self._window.append((position, self._y[-1]))
+        #the partners of the next position are the F-1 positions before it
+        while self._window and self._window[0][0] <= position + 1 - self.frequency:
+            self._window.popleft()
+
+    def _lastM(self):
+        '''
+        The largest min(y[i], y[last]) over the positions i less than F before the newest one
+        '''
+        if self._y == [] or not self._window:
+            return -math.inf
+        return min(self._y[-1], self._window[0][1])
+
+    def _rebuild(self, data):
+        '''
+        Rebuilds every structure from scratch, from "data" and the groups seen so far
+        '''
+        if data != None:
+            if not isinstance(data, dict):
+                data = _rowColumns(data)
+            if countRows(data) > 0:
+                keys, observationSum, observationDays, monthLow, monthHigh = _groupData(data, self.option)
+                for group in zip(keys.tolist(), observationSum.tolist(), observationDays.tolist(),
+                                 monthLow.tolist(), monthHigh.tolist()):
+                    self._groups[group[0]] = list(group[1:])
+        keys = sorted(self._groups)
+        finished = {}
+        if keys:
+            groups = np.array([self._groups[key] for key in keys], dtype=np.float64)
+            finished = _finishGroups(np.array(keys), groups[:, 0], groups[:, 1], groups[:, 2].astype(np.int8),
+                                     groups[:, 3].astype(np.int8), self.dataType, self.option)
+        self.aggregated = {}
+        self._keys = {}
+        self._values = _SortedValues()
+        self._sequence = _SortedValues()    #every y, for thresholdA
+        self._y = []
+        self._window = collections.deque()  #(position, y) with decreasing y, over the F-1 positions before the newest
+        self._prefixM = -math.inf           #M over the pairs that don't involve the newest position
+        for key in keys:
+            value = finished[key]
+            self.aggregated[key] = value
+            if value != None:
+                self._keys.setdefault(value, []).append(key)
+                self._values.insert(value)
+            self._commitLast()
+            y = self._sequenceValue(value)
+            self._sequence.insert(y)
+            self._y.append(y)
+
+class _SortedValues:
+    '''
+    A sorted multiset of numbers with O(log n) insert, remove, indexing and
+    bisectRight (an indexable skiplist)
+    '''
+    LEVELS = 32
+
+    def __init__(self, values=()):
+        self._random = random.Random(0)
+        self._end = [math.inf, None, None]
+        #nodes are [value, next node at each level, distance to it at each level]
+        self._head = [None, [self._end]*self.LEVELS, [1]*self.LEVELS]
+        self._size = 0
+        for value in values:
+            self.insert(value)
 
-                if observationDays<correctNoOfObs:
-                #There are holes
-                check = False
-            elif observationDays>correctNoOfObs:
-                print("What the hell how can there be more observations than days???")
-                check = False
-                #else:
-                #   exactly the same no. of days as observations. Sweet!
+    def __len__(self):
+        return self._size
 
-                #Quit if already useless
-                if check == False:
-                    results[group] = None
+    def __iter__(self):
+        node = self._head[1][0]
+        while node is not self._end:
+            yield node[0]
+            node = node[1][0]
 
+    def __getitem__(self, index):
+        if not 0 <= index < self._size:
+            raise IndexError("index out of range")
+        node = self._head
+        index += 1
+        for level in reversed(range(self.LEVELS)):
+            while node[2][level] <= index:
+                index -= node[2][level]
+                node = node[1][level]
+        return node[0]
 
+    def bisectRight(self, value):
+        '''
+        The number of values less than or equal to "value"
+        '''
+        node = self._head
+        rank = 0
+        for level in reversed(range(self.LEVELS)):
+            while node[1][level][0] <= value:
+                rank += node[2][level]
+                node = node[1][level]
+        return rank
 
-                    #Add the data to the "results" dict. this
-                    #will be a sum or average depending on the
-                    #"dataType"
-                    #if dataType == "IDCJAC0009":
-                    #        results[group] = observationSum
-                    #        else:
-                    #results[group] = observationSum/observationDays
+    def insert(self, value):
+        chain = [None]*self.LEVELS
+        steps = [0]*self.LEVELS
+        node = self._head
+        for level in reversed(range(self.LEVELS)):
+            while node[1][level][0] <= value:
+                steps[level] += node[2][level]
+                node = node[1][level]
+            chain[level] = node
+        height = 1
+        while height < self.LEVELS and self._random.random() < 0.5:
+            height += 1
+        new = [value, [None]*height, [None]*height]
+        distance = 0
+        for level in range(height):
+            previous = chain[level]
+            new[1][level] = previous[1][level]
+            previous[1][level] = new
+            new[2][level] = previous[2][level] - distance
+            previous[2][level] = distance + 1
+            distance += steps[level]
+        for level in range(height, self.LEVELS):
+            chain[level][2][level] += 1
+        self._size += 1
 
+    def remove(self, value):
+        chain = [None]*self.LEVELS
+        node = self._head
+        for level in reversed(range(self.LEVELS)):
+            while node[1][level][0] < value:
+                node = node[1][level]
+            chain[level] = node
+        found = chain[0][1][0]
+        if found is self._end or found[0] != value:
+            raise ValueError("value not found")
+        for level in range(len(found[1])):
+            previous = chain[level]
+            previous[2][level] += found[2][level] - 1
+            previous[1][level] = found[1][level]
+        for level in range(len(found[1]), self.LEVELS):
+            chain[level][2][level] -= 1
+        self._size -= 1
+
+    def __getstate__(self):
+        #the nodes are linked too deeply to pickle one by one
+        return list(self)
+
+    def __setstate__(self, values):
+        self.__init__(values)
+
+#------SKETCH FUNCTIONS------
+class QuantileSketch:
+    """
+    A KLL quantile sketch: answers rank queries over any number of values in
+    small fixed memory, to within "epsilon" times the number of values
+    The top level holds k = sqrt(2*ln(2/FAILURE))/epsilon items, the KLL bound for
+    a rank error of epsilon with probability 1 - FAILURE (about 7.5/epsilon; the
+    worst error measured on normal and uniform data is under half of epsilon)
+    Values are added with update(), and sketches of different files or
+    processes are combined with merge(). Sketches pickle, so they can be
+    returned from worker processes
+    """
+    SHRINK = 2.0/3.0    #capacity of each level relative to the level above it
+    FAILURE = 1e-12     #chance of missing the epsilon bound that k is sized for
+
+    def __init__(self, epsilon=0.001, seed=0):
+        if not 0 < epsilon < 1:
+            raise ValueError("epsilon must be between 0 and 1")
+        self.epsilon = epsilon
+        self.k = int(math.ceil(math.sqrt(2*math.log(2/self.FAILURE))/epsilon))
+        self.count = 0
+        self.levels = [np.zeros(0)]     #items of level h each stand for 2**h values
+        self._random = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def update(self, values):
+        """
+        Adds an array (or list) of values. None and nan are skipped
         """
+        values = np.asarray([value for value in values if value != None] if isinstance(values, list) else values,
+                            dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
 
-    #Make sure that the list "X" does not only contain None values
-    #This might happen if you filter for a month, and aggregate monthly
-    #assert not all([x==None for x in results.values()]), "There is no useable data for this aggregation"
+    def merge(self, other):
+        """
+        Adds every value summarised by another sketch
+        """
+        for h, items in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.zeros(0))
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.count += other.count
+        self._compress()
+
+    def value(self, rank):
+        """
+        The value at 0-based position "rank" of the sorted values (approximately)
+        """
+        assert self.count > 0, "There is no useable data for this aggregation"
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2**h, dtype=np.int64) for h, items in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        position = min(np.searchsorted(cumulative, rank, side="right"), len(items) - 1)
+        return float(items[order][position])
+
+    def _capacity(self, h):
+        return max(2, int(math.ceil(self.k*self.SHRINK**(len(self.levels) - 1 - h))))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                items = np.sort(self.levels[h])
+                if len(items)%2 == 1:   #the odd one out waits at this level
+                    kept, items = items[:1], items[1:]
+                else:
+                    kept = items[:0]
+                promoted = items[self._random.integers(0, 2)::2]
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                self.levels[h] = kept
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+def sketchThresholdB(sketch, F, mode):
+    '''
+    calcThresholdB's threshold, from a QuantileSketch of the aggregated values instead
+    of the values themselves. Returns the threshold only, since the sketch has no keys
+    '''
+    if type(F) != int:  #F is not an integer
+        raise ValueError("F is must be an an integer")
+    if mode != 'high' and mode != 'low': #invalid mode is entered
+        raise ValueError("mode must be either 'high' or 'low'")
+    return sketch.value(_quantileIndex(len(sketch), F, mode))
+
+@weather_instrument.stage("sketchAggregate")
+def sketchAggregate(path, filt, dataType, option, epsilon=0.001, chunkRows=None, sketch=None, window=None):
+    """
+    Streams a file like streamAggregate, but adds each aggregated value to a
+    QuantileSketch as soon as its group is complete instead of keeping the groups,
+    so memory stays fixed however long the series is
+    Every station is aggregated separately. Each station's rows must be in date
+    order, as they are in BOM files, but stations may be interleaved: the last
+    open group of every station is held until that station's rows move past it
+    Supports options 1 to 4 and 6
+    Returns the sketch ("sketch" if given, otherwise a new one with "epsilon")
+    """
+    assert dataType=="IDCJAC0009" or dataType=="IDCJAC0010", "Incorrect data type"
+    assert option in (1, 2, 3, 4, 6), "Wrong option number. 'option' must be 1, 2, 3, 4 or 6"
+    if sketch == None:
+        sketch = QuantileSketch(epsilon)
 
+    carried = None      #rows of each station's last group seen, which may go on in the next chunk
+    flushed = {}        #station -> the largest of its keys already added to the sketch
+    for chunk in streamColumns(path, filt, chunkRows):
+        if option == 6:
+            chunk = _filterRows(chunk, _groupKeys(chunk, option, window) >= 0)
+        if countRows(chunk) == 0:
+            continue
+        if carried != None:
+            chunk = dict([(name, np.concatenate([carried[name], chunk[name]])) for name in COLUMNS],
+                         levels=chunk["levels"])
+        station = chunk["station"]
+        keys = _groupKeys(chunk, option, window) + station.astype(np.int64)*STATION_KEY
+        for number in np.unique(station).tolist():
+            if keys[station == number].min() <= flushed.get(number, -1):
+                raise ValueError("The file is not in date order for station " + str(number))
+        stations, inverse = np.unique(station, return_inverse=True)
+        lastKey = np.full(len(stations), -1, dtype=np.int64)
+        np.maximum.at(lastKey, inverse.reshape(-1), keys)
+        complete = keys != lastKey[inverse.reshape(-1)]
+        carried = _filterRows(chunk, ~complete)
+        _sketchGroups(sketch, _filterRows(chunk, complete), dataType, option, window)
+        for number in np.unique(station[complete]).tolist():
+            flushed[number] = keys[complete & (station == number)].max()
+    if carried != None:
+        _sketchGroups(sketch, carried, dataType, option, window)
+    return sketch
+
+def _filterRows(data, passed):
+    """
+    The rows of openColumns' columns where "passed" is True
+    """
+    newdata = {"levels": data["levels"]}
+    for name in COLUMNS:
+        newdata[name] = data[name][passed]
+    return newdata
+
+def _sketchGroups(sketch, data, dataType, option, window=None):
+    if countRows(data) == 0:
+        return
+    keys, observationSum, observationDays, monthLow, monthHigh = _groupData(data, option, True, window)
+    values, useable = _groupValues(keys%STATION_KEY, observationSum, observationDays, monthLow, monthHigh, dataType, option, window)
+    sketch.update(values[useable])
+
+#------COMPOUND FUNCTIONS------
+@weather_instrument.stage("joinAggregates")
+def joinAggregates(X, Y):
+    '''
+    Lines up two aggregated series (eg. rainfall and temperature from aggregateData
+    with the same option) on their keys with a sort-merge join
+    Returns NumPy arrays (keys, x, y) of the keys where both have a value, in key order
+    '''
+    keysX = np.fromiter(X.keys(), dtype=np.int64, count=len(X))
+    keysY = np.fromiter(Y.keys(), dtype=np.int64, count=len(Y))
+    valuesX = np.array([np.nan if value == None else value for value in X.values()], dtype=np.float64)
+    valuesY = np.array([np.nan if value == None else value for value in Y.values()], dtype=np.float64)
+    orderX = np.argsort(keysX, kind="stable")
+    orderY = np.argsort(keysY, kind="stable")
+    keysX, valuesX = keysX[orderX], valuesX[orderX]
+    keysY, valuesY = keysY[orderY], valuesY[orderY]
+
+    if len(keysX) == 0:
+        return keysX, valuesX, valuesX
+
+    #merge: where each key of Y would go among the keys of X, and whether it is there
+    position = np.minimum(np.searchsorted(keysX, keysY), len(keysX) - 1)
+    matched = keysX[position] == keysY
+    keys, x, y = keysY[matched], valuesX[position[matched]], valuesY[matched]
+    useable = ~np.isnan(x) & ~np.isnan(y)
+    return keys[useable], x[useable], y[useable]
+
+def compoundEvents(rainfall, temperature, frequency, rainMode='low', temperatureMode='high'):
+    '''
+    Finds compound events in aggregated rainfall and temperature series with the same
+    keys, eg. hot and dry months with rainMode 'low' and temperatureMode 'high'
+    Returns a dictionary of
+        "keys", "rainfall", "temperature" - the joined series (see joinAggregates)
+        "returnPeriod" - the empirical joint return period of each key (see jointReturnPeriods)
+        "events" - [(key, rainfall, temperature, return period), ...] of the keys
+            whose joint return period is at least "frequency", most extreme first
+        "thresholds" - the calcThresholdB threshold of each series for "frequency"
+        "jointCount" - how many keys are beyond both thresholds
+        "jointReturnPeriod" - how often that happens: n/jointCount, or None if it never does
+    '''
+    if type(frequency) != int:  #F is not an integer
+        raise ValueError("F is must be an an integer")
+    keys, x, y = joinAggregates(rainfall, temperature)
+    result = {"keys": keys.tolist(), "rainfall": x.tolist(), "temperature": y.tolist(), "returnPeriod": [],
+              "events": [], "thresholds": None, "jointCount": 0, "jointReturnPeriod": None}
+    if len(keys) == 0:
+        return result
+
+    periods = jointReturnPeriods(x, y, rainMode, temperatureMode)
+    rare = np.flatnonzero(periods >= frequency)
+    rare = rare[np.argsort(-periods[rare], kind="stable")]
+    result["returnPeriod"] = periods.tolist()
+    result["events"] = list(zip(keys[rare].tolist(), x[rare].tolist(), y[rare].tolist(), periods[rare].tolist()))
+
+    thresholdX = calcThresholdB(dict(zip(keys.tolist(), x.tolist())), frequency, rainMode)[0]
+    thresholdY = calcThresholdB(dict(zip(keys.tolist(), y.tolist())), frequency, temperatureMode)[0]
+    beyondX = x >= thresholdX if rainMode == 'high' else x <= thresholdX
+    beyondY = y >= thresholdY if temperatureMode == 'high' else y <= thresholdY
+    joint = int(np.count_nonzero(beyondX & beyondY))
+    result["thresholds"] = (thresholdX, thresholdY)
+    result["jointCount"] = joint
+    result["jointReturnPeriod"] = len(keys)/joint if joint else None
+    return result
+
+def runCompound(rainfallFile, temperatureFile, station, option=1, frequency=20, rainMode='low',
+                temperatureMode='high', month=None, quality=None, window=None):
+    '''
+    compoundEvents for one station without prompting: aggregates the station's
+    rainfall and temperature the same way and joins them. Either may be a .csv file
+    or an archive directory written by weather_archive, and both may be the same
+    archive. The other arguments are as in runQuery
+    '''
+    aggregations = []
+    for path, code in ((rainfallFile, "IDCJAC0009"), (temperatureFile, "IDCJAC0010")):
+        if os.path.isdir(path):
+            import weather_archive
+            data = weather_archive.readArchive(path, [code, station, None, month, None, None, None, quality])
+        else:
+            data = openColumns(path)
+        aggregations.append(queryAggregate(data, code, station, option, month, quality, window))
+    return compoundEvents(aggregations[0], aggregations[1], frequency, rainMode, temperatureMode)
+
+#------QUERY FUNCTIONS------
+def runQuery(filename, code, station=None, option=1, frequency=20, mode='high', month=None, quality=None, window=None, stream=False):
+    '''
+    Runs the whole program for one query without prompting for input
+    The arguments match getInput's answers: "code" is the product code, "station" the
+    station number (None for all), "month" filters on one month, "quality" is 'Y' to
+    require quality assured data, and "window" is the run length in days for option 5
+    or the season for option 6
+    Returns a dictionary of
+        "aggregated" - the aggregated data (see aggregateData), empty if nothing passed the filter
+        "thresholdA", "thresholdB" - the calcThresholdA/calcThresholdB results, None if there is no useable data
+    With station None every station is aggregated separately, and the result is
+    {station: that dictionary, ...} instead (see queryStationThresholds)
+    With "stream" the file is aggregated a chunk at a time by streamAggregate
+    instead of being opened whole (options 1 to 4 and 6)
+    '''
+    if stream:
+        filt = [code, station, None, month, None, None, None, quality]
+        if station == None:
+            stations = streamAggregate(filename, filt, code, option, window=window, byStation=True)
+            return queryStationThresholds(stations, frequency, mode)
+        return queryThresholds(streamAggregate(filename, filt, code, option, window=window), frequency, mode)
+    data = openColumns(filename)
+    if station == None:
+        return queryStationThresholds(queryStations(data, code, option, month, quality, window), frequency, mode)
+    agg_data = queryAggregate(data, code, station, option, month, quality, window)
+    return queryThresholds(agg_data, frequency, mode)
+
+def queryAggregate(data, code, station=None, option=1, month=None, quality=None, window=None):
+    '''
+    Filters and aggregates already opened data for runQuery
+    Returns {} if nothing passes the filter
+    Station None is only allowed if the rows that pass are all from one station,
+    since aggregating several stations together would merge their values;
+    queryStations aggregates each station separately
+    '''
+    filt = [code, station, None, month, None, None, None, quality]
+    clean_data = filterData(data, filt)
+    if countRows(clean_data) == 0:
+        return {}
+    stations = clean_data["station"] if isinstance(clean_data, dict) else [row[1] for row in clean_data]
+    if station == None and len(np.unique(stations)) > 1:
+        raise ValueError("The data holds several stations - give a station, or use queryStations")
+    return aggregateData(clean_data, code, option, window)
+
+def queryStations(data, code, option=1, month=None, quality=None, window=None):
+    '''
+    Filters already opened data like queryAggregate for every station, and aggregates
+    each station separately. Returns aggregateStations' {station: aggregated data},
+    or {} if nothing passes the filter
+    '''
+    filt = [code, None, None, month, None, None, None, quality]
+    clean_data = filterData(data, filt)
+    if countRows(clean_data) == 0:
+        return {}
+    return aggregateStations(clean_data, code, option, window)
+
+def queryDailySeries(data, code, station=None, month=None, quality=None):
+    '''
+    Filters already opened data like queryAggregate, and lays each station's rows
+    out with dailySeries, which option 5 rolls every window from
+    Returns {station: daily series}, for every station if "station" is None,
+    or {} if nothing passes the filter
+    '''
+    filt = [code, station, None, month, None, None, None, quality]
+    clean_data = filterData(data, filt)
+    if countRows(clean_data) == 0:
+        return {}
+    if not isinstance(clean_data, dict):
+        clean_data = _rowColumns(clean_data)
+    series = {}
+    for number in np.unique(clean_data["station"]).tolist():
+        series[number] = dailySeries(_filterColumns(clean_data, [None, number] + [None]*6))
+    return series
+
+def queryThresholds(agg_data, frequency, mode):
+    '''
+    Calculates both thresholds of aggregated data for runQuery
+    '''
+    result = {"aggregated": agg_data, "thresholdA": None, "thresholdB": None}
+    if all([x==None for x in agg_data.values()]):
+        return result
+    result["thresholdA"] = calcThresholdA(agg_data, frequency, mode)
+    result["thresholdB"] = calcThresholdB(agg_data, frequency, mode)
+    return result
+
+def queryStationThresholds(stations, frequency, mode):
+    '''
+    queryThresholds for every station of queryStations' result at once (see stationThresholds)
+    Returns {station: {"aggregated", "thresholdA", "thresholdB"}, ...}
+    '''
+    results = {}
+    if stations:
+        table = stationThresholds(stations, frequency, mode)
+        for station, agg_data in stations.items():
+            results[station] = {"aggregated": agg_data, "thresholdA": table[station]["A"],
+                                "thresholdB": table[station]["B"]}
     return results
 
 #------OUTPUT FUNCTIONS------
 def outputResults(x):
     """
-    Hurry up and write this Michael you slave!
+    Prints a table of thresholds per station, as returned by stationThresholds
     """
-    pass
+    print("%-10s %-30s %-30s" % ("Station", "calcThresholdA result", "calcThresholdB result"))
+    for station, thresholds in x.items():
+        cells = []
+        for method in ("A", "B"):
+            if thresholds[method] == None:
+                cells.append("-")
+            else:
+                cells.append("%g %s" % (thresholds[method][0], thresholds[method][1]))
+        print("%-10s %-30s %-30s" % (station, cells[0], cells[1]))
 
-def displayGraph(agg_data, method_A_threshold, method_B_threshold):
+@weather_instrument.stage("displayGraph")
+def displayGraph(agg_data, method_A_threshold, method_B_threshold, curve=None, path=None):
+    """
+    Graphs the aggregated data with a line at each threshold
+    If a return-period curve from thresholdCurve is given it is graphed alongside
+    With "path" the graph is written to that .png/.svg file by weather_render
+    instead of being shown, which needs no display
+    """
+    if path != None:
+        import weather_render
+        return weather_render.renderChart(agg_data, method_A_threshold, method_B_threshold, path, curve)
+    import matplotlib.pyplot as mpl
+    if curve != None:
+        mpl.subplot(1, 2, 1)
     years = list(agg_data.keys())
     y = []
     for thing in list(agg_data.values()):
@@ -497,48 +1887,101 @@ def displayGraph(agg_data, method_A_threshold, method_B_threshold):
     mpl.plot([0, len(y) + 1], [method_A_threshold[0], method_A_threshold[0]], '--r')  # the threshold line
     mpl.plot([0, len(y) + 1], [method_B_threshold[0], method_B_threshold[0]], '--g')  # the threshold line
     mpl.xticks(x + 0.5, years, rotation=90)
+    if curve != None:
+        mpl.subplot(1, 2, 2)
+        displayCurve(curve)
     mpl.show()
 
+def displayCurve(curve):
+    """
+    Plots a return-period curve from thresholdCurve: threshold against frequency
+    for method A (red) and method B (green). Frequencies without a threshold are skipped
+    """
+    import matplotlib.pyplot as mpl
+    for method, style in (("A", "o-r"), ("B", "s-g")):
+        points = [(F, curve[F][method][0]) for F in sorted(curve) if curve[F][method] != None]
+        mpl.plot([F for F, threshold in points], [threshold for F, threshold in points], style, label="Method " + method)
+    mpl.xscale("log")
+    mpl.xlabel("1 in F")
+    mpl.legend()
+
 #--------MAIN PROGRAM---------
+def main():
+    '''
+    The interactive program - prompts for a query with getInput and prints
+    and graphs its thresholds
+    Set the environment variable WEATHER_STATS to a path to print how long each
+    stage took and save the timings there as JSON (see weather_instrument)
+    '''
+    statsPath = os.environ.get("WEATHER_STATS")
+    if statsPath:
+        weather_instrument.enable(memory=True)
+    try:
+        interactiveQuery()
+    finally:
+        if statsPath:
+            for stageName, total in weather_instrument.summary().items():
+                print("%-15s %4d calls %10.4fs %10d rows in %10d rows out  peak %s bytes" % (
+                    stageName, total["calls"], total["seconds"], total["rowsIn"], total["rowsOut"], total["peakBytes"]))
+            weather_instrument.exportJson(statsPath)
+
+def interactiveQuery():
+    '''
+    Prompts for one query and prints and graphs its thresholds
+    '''
+
+    #Get input file from User
+    filt, mode, frequency, aggI, filename, option, windows = getInput()
+    #print("filt=", filt)
+    #print(filt, mode, frequency, aggI, filename)
+    code = filt[0]
+    #Assignment example:
+    #filt = ['IDCJAC0009', 70247, None, 5, None, None, None, None]
+    #mode = "high"
+    #frequency = 20
+    #aggI = 2
+    #filename = "/Users/michaelvernon/Google Drive/weather/Rainfall_Canberra_070247.csv"
+    #filename2 = "C:/Users/Jack/Google Drive/weather/Rainfall_Canberra_070247.csv"
+
+    #Open the data file
+    data = openColumns(filename)
+
+    #Filter the data based on user input. Quit if it filters everything
+    clean_data = filterData(data, filt)
+    if countRows(clean_data) == 0:
+        print("There is no data that fits the parameters you provided. This program will now finish")
+        return
+
+    #'All' stations gives a table of thresholds for each station instead of merging them
+    if filt[1] == None:
+        for window in (windows or [None]):
+            outputResults(stationThresholds(aggregateStations(clean_data, code, option, window), frequency, mode))
+        return
+
+    #Aggregate the data. Rolling totals share one daily series for every window length
+    if option == 5:
+        series = dailySeries(clean_data)
+        aggregations = [rollingData(series, code, window) for window in windows]
+    else:
+        aggregations = [aggregateData(clean_data, code, option, window) for window in (windows or [None])]
+
+    for agg_data in aggregations:
+        #Skip the aggregation if useless
+        print("Aggregated data:", agg_data, len(agg_data), "\n")
+        if all([x==None for x in agg_data.values()]):
+            print("There is no data that fits the parameters you provided.")
+            continue
+
+        #Calculate thresholds, along with the standard return-period curve
+        curve = thresholdCurve(agg_data, sorted(set(RETURN_PERIODS + [frequency])), mode)
+        method_A_threshold = curve[frequency]["A"]
+        method_B_threshold = curve[frequency]["B"]
+        if method_A_threshold == None:
+            print ('No values in the sequence, satisfy this condition')
+        print("calcThresholdA result:", method_A_threshold)
+        print("calcThresholdB result:", method_B_threshold)
+
+        displayGraph(agg_data, method_A_threshold, method_B_threshold, curve)
 
-#Get input file from User
-filt, mode, frequency, aggI, filename, option = getInput()
-#print("filt=", filt)
-#print(filt, mode, frequency, aggI, filename)
-code = filt[0]
-#Assignment example:
-#filt = ['IDCJAC0009', 70247, None, 5, None, None, None, None]
-#mode = "high"
-#frequency = 20
-#aggI = 2
-#filename = "/Users/michaelvernon/Google Drive/weather/Rainfall_Canberra_070247.csv"
-#filename2 = "C:/Users/Jack/Google Drive/weather/Rainfall_Canberra_070247.csv"
-
-#Open the data file
-data = openData(filename)
-print()
-print("aggI is", aggI)
-print()
-print("filt is:", filt)
-print()
-
-#Filter the data based on user input. Quit if it filters everything
-clean_data = filterData(data, filt)
-if clean_data == []:
-    print("There is no data that fits the parameters you provided. This program will now finish")
-    sys.exit()
-
-#Aggregate the data. Quit if useless
-agg_data = aggregateData(clean_data, code, option)
-print("Aggregated data:", agg_data, len(agg_data), "\n")
-if all([x==None for x in agg_data.values()]):
-    print("There is no data that fits the parameters you provided. This program will now finish")
-    sys.exit()
-
-#Calculate thresholds
-method_A_threshold = calcThresholdA(agg_data, frequency, mode)
-method_B_threshold = calcThresholdB(agg_data, frequency, mode)
-print("calcThresholdA result:", method_A_threshold)
-print("calcThresholdB result:", method_B_threshold)
-
-displayGraph(agg_data, method_A_threshold, method_B_threshold)
+if __name__ == "__main__":
+    main()
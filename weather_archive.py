@@ -0,0 +1,232 @@
+"""
+Chunked columnar archive of BOM data, for fast selective queries
+
+writeArchive converts any number of BOM .csv files into one archive directory.
+The rows are sorted by product code, station and date and cut into row groups
+of ARCHIVE_CHUNK_ROWS rows. Every row group has a zone map: the min and max of
+its product code, station, year and day, and bitmasks of the months and quality
+flags it holds. readArchive checks a filterData "filt" against the zone maps,
+skips the row groups that cannot match, and memory-maps only the columns it
+is asked for, so a query for one station and one month of a decades-long,
+many-station archive only touches a few row groups.
+
+Layout of an archive directory:
+    archive.json         - {"rows", "chunkRows", "levels", "sources"}
+    zones.npz            - the zone map arrays, one entry per row group
+    <column>.npy         - every column of weather.COLUMNS, in sorted row order
+
+The archive is written to a temporary directory and renamed into place.
+
+Usage: python weather_archive.py archive_dir file1.csv file2.csv ... [--chunk-rows N]
+"""
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import weather
+import weather_instrument
+
+ARCHIVE_CHUNK_ROWS = 1 << 16    #rows per row group
+
+#Columns with min/max statistics, and columns with a bitmask of the values seen
+_RANGE_COLUMNS = ["code", "station", "year", "day"]
+_MASK_COLUMNS = ["month", "quality"]
+
+def writeArchive(paths, archive, chunkRows=None):
+    """
+    Converts the BOM .csv files in "paths" into an archive directory "archive",
+    replacing any archive already there
+    "chunkRows" is the number of rows per row group (ARCHIVE_CHUNK_ROWS by default)
+    Returns the number of rows written
+    """
+    if chunkRows == None:
+        chunkRows = ARCHIVE_CHUNK_ROWS
+    sources = [weather.openColumns(path) for path in paths]
+
+    #Every file has its own levels - merge them, sorted so codes sort like the strings
+    levels = {}
+    for name in ("code", "quality"):
+        levels[name] = sorted(set([level for source in sources for level in source["levels"][name]]))
+    data = {"levels": levels}
+    for name in weather.COLUMNS:
+        columns = []
+        for source in sources:
+            column = np.asarray(source[name])
+            if name in levels:
+                remap = np.array([levels[name].index(level) for level in source["levels"][name]] or [0], dtype=np.int8)
+                column = remap[column]
+            columns.append(column)
+        if columns == []:
+            data[name] = np.zeros(0, weather._COLUMN_DTYPES[name])
+        else:
+            data[name] = np.concatenate(columns)
+
+    #stable, so observations of the same day keep their file order
+    order = np.lexsort((data["day"], data["month"], data["year"], data["station"], data["code"]))
+    for name in weather.COLUMNS:
+        data[name] = data[name][order]
+    rows = len(order)
+
+    zones = _zoneMaps(data, chunkRows)
+    parent = os.path.dirname(os.path.abspath(archive))
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+    try:
+        for name in weather.COLUMNS:
+            np.save(os.path.join(temporary, name + ".npy"), np.ascontiguousarray(data[name]))
+        np.savez(os.path.join(temporary, "zones.npz"), **zones)
+        with open(os.path.join(temporary, "archive.json"), "w") as f:
+            json.dump({"rows": rows, "chunkRows": chunkRows, "levels": levels,
+                       "sources": [os.path.abspath(path) for path in paths]}, f)
+        if os.path.isdir(archive):
+            trash = temporary + "-old"
+            os.rename(archive, trash)
+            os.rename(temporary, archive)
+            shutil.rmtree(trash, ignore_errors=True)
+        else:
+            os.rename(temporary, archive)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+    return rows
+
+def _zoneMaps(data, chunkRows):
+    """
+    Returns the zone map arrays of every row group of "data"
+    """
+    rows = len(data["year"])
+    starts = np.arange(0, rows, chunkRows)
+    zones = {}
+    if rows == 0:
+        for name in _RANGE_COLUMNS:
+            zones[name + "Min"] = zones[name + "Max"] = np.zeros(0, np.int64)
+        for name in _MASK_COLUMNS:
+            zones[name + "Mask"] = np.zeros(0, np.int64)
+        return zones
+    for name in _RANGE_COLUMNS:
+        column = data[name].astype(np.int64)
+        zones[name + "Min"] = np.minimum.reduceat(column, starts)
+        zones[name + "Max"] = np.maximum.reduceat(column, starts)
+    for name in _MASK_COLUMNS:
+        bits = np.left_shift(np.int64(1), data[name].astype(np.int64))
+        zones[name + "Mask"] = np.bitwise_or.reduceat(bits, starts)
+    return zones
+
+@weather_instrument.stage("readArchive")
+def readArchive(archive, filt=None, columns=None):
+    """
+    Reads the rows of an archive that pass "filt" (see filterData)
+    Returns weather.openColumns' representation, with only the "columns"
+    asked for (every column of weather.COLUMNS by default), in archive order:
+    sorted by product code, station and date
+    Row groups whose zone maps rule out "filt" are never read
+    """
+    meta, zones = _openArchive(archive)
+    if columns == None:
+        columns = weather.COLUMNS
+    if filt == None:
+        filt = [None]*len(weather.COLUMNS)
+    assert len(filt)==len(weather.COLUMNS), "Incorrect filter length"
+
+    levels = meta["levels"]
+    chunks = candidateChunks(archive, filt)
+    tests = []
+    for name, b in zip(weather.COLUMNS, filt):
+        if b != None and name in levels:
+            tests.append((name, levels[name].index(b) if b in levels[name] else -1))
+        elif b != None:
+            tests.append((name, b))
+
+    mapped = {}
+    for name in set(columns) | set([name for name, b in tests]):
+        mapped[name] = np.load(os.path.join(archive, name + ".npy"), mmap_mode="r")
+
+    chunkRows = meta["chunkRows"]
+    parts = dict([(name, []) for name in columns])
+    for chunk in chunks.tolist():
+        window = slice(chunk*chunkRows, (chunk + 1)*chunkRows)
+        passed = None
+        for name, b in tests:
+            if _chunkCertain(zones, name, b, chunk):
+                continue    #every row of the row group passes this test
+            test = mapped[name][window] == b
+            passed = test if passed is None else passed & test
+        for name in columns:
+            column = mapped[name][window]
+            parts[name].append(np.array(column if passed is None else column[passed]))
+
+    data = {"levels": levels}
+    for name in columns:
+        if parts[name] == []:
+            data[name] = np.zeros(0, weather._COLUMN_DTYPES[name])
+        else:
+            data[name] = np.concatenate(parts[name])
+    return data
+
+def candidateChunks(archive, filt):
+    """
+    Returns the indexes of the row groups whose zone maps don't rule out "filt"
+    """
+    meta, zones = _openArchive(archive)
+    levels = meta["levels"]
+    keep = np.ones(len(zones["yearMin"]), dtype=bool)
+    for name, b in zip(weather.COLUMNS, filt):
+        if b == None:
+            continue
+        if name in levels:
+            if b not in levels[name]:
+                keep[:] = False
+                break
+            b = levels[name].index(b)
+        if name in _RANGE_COLUMNS:
+            keep &= (zones[name + "Min"] <= b) & (b <= zones[name + "Max"])
+        elif name in _MASK_COLUMNS:
+            if not 0 <= b < 63:
+                keep[:] = False
+                break
+            keep &= (zones[name + "Mask"] & (1 << b)) != 0
+    return np.flatnonzero(keep)
+
+def _chunkCertain(zones, name, b, chunk):
+    """
+    True if the zone map shows every row of row group "chunk" has "b" in column "name"
+    """
+    if name in _RANGE_COLUMNS:
+        return zones[name + "Min"][chunk] == b and zones[name + "Max"][chunk] == b
+    if name in _MASK_COLUMNS:
+        return 0 <= b < 63 and zones[name + "Mask"][chunk] == (1 << b)
+    return False
+
+_archives = {}  #archive path -> (archive.json mtime, meta, zones)
+
+def _openArchive(archive):
+    """
+    Returns the metadata and zone maps of an archive, read once per process
+    and again only if the archive is rewritten
+    """
+    path = os.path.join(archive, "archive.json")
+    mtime = os.stat(path).st_mtime_ns
+    cached = _archives.get(os.path.abspath(archive))
+    if cached != None and cached[0] == mtime:
+        return cached[1], cached[2]
+    with open(path, "r") as f:
+        meta = json.load(f)
+    with np.load(os.path.join(archive, "zones.npz")) as f:
+        zones = dict([(name, f[name]) for name in f.files])
+    _archives[os.path.abspath(archive)] = (mtime, meta, zones)
+    return meta, zones
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert BOM .csv files into a columnar archive")
+    parser.add_argument("archive", help="archive directory to write")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--chunk-rows", type=int, help="rows per row group (default: %d)" % ARCHIVE_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    rows = writeArchive(args.files, args.archive, args.chunk_rows)
+    print("Wrote", rows, "rows to", args.archive)
+
+if __name__ == "__main__":
+    main()
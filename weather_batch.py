@@ -0,0 +1,289 @@
+"""
+Runs many weather queries from a job file, without prompting
+
+A job file is JSON - a list of jobs (or {"jobs": [...]}). Every field of a job
+may be a single value or a list, and a job runs every combination of its lists:
+    {"file": ["Rainfall_Canberra_070247.csv"],
+     "product": "rainfall",             - rainfall/rain/IDCJAC0009 or temperature/temp/IDCJAC0010
+     "station": ["canberra", 70072],    - station number or name, "all" (the default) for each station
+     "option": [1, 3],                  - aggregateData's option, 1 by default
+     "month": null,                     - month number to filter on
+     "quality": null,                   - "Y" to require quality assured data
+     "window": null,                    - run length in days for option 5, or season for option 6
+     "frequency": [2, 5, 10, 20, 50, 100],
+     "mode": ["high", "low"]}
+
+"file" may also be an archive directory written by weather_archive, in which
+case each query only reads the row groups its filter can match.
+Each file is opened once, and queries that only differ in frequency or mode
+share one filtered and aggregated series, whose thresholds for every frequency
+come from one return-period curve. A query for "all" stations gives a row for each
+station in the file. A query that fails is reported in the "error" column
+and doesn't stop the others. Results are written as a .csv table, and --charts also renders each query's
+series and thresholds to a .png file (see weather_render)
+
+Usage: python weather_batch.py jobs.json [-o results.csv] [--stats stats.json] [--metrics weather.prom]
+                               [--profile STAGE [--profiler sampling]] [--charts DIR]
+"""
+import os
+import sys
+import json
+import argparse
+import itertools
+import csv
+import weather
+import weather_instrument
+
+PRODUCTS = {"rainfall": "IDCJAC0009", "rain": "IDCJAC0009",
+            "temperature": "IDCJAC0010", "temp": "IDCJAC0010"}
+STATIONS = {"sydney": 66062, "syd": 66062, "canberra": 70247, "can": 70247,
+            "queanbeyan": 70072, "q": 70072, "all": None, "any": None}
+
+#The fields of a job, their defaults, and the order of the result table
+FIELDS = ["file", "product", "station", "option", "month", "quality", "window", "frequency", "mode"]
+DEFAULTS = {"station": None, "option": 1, "month": None, "quality": None, "window": None,
+            "frequency": 20, "mode": "high"}
+RESULT_FIELDS = FIELDS + ["thresholdA", "keysA", "thresholdB", "keysB", "error"]
+
+def readJobs(path):
+    """
+    Reads a job file and returns its list of jobs
+    """
+    with open(path, "r") as f:
+        jobs = json.load(f)
+    if isinstance(jobs, dict):
+        jobs = jobs["jobs"]
+    return jobs
+
+def expandJobs(jobs):
+    """
+    Returns one query dictionary (keyed by FIELDS) per combination of the values in each job
+    Only options 5 and 6 use a window, so other options get window None, and
+    combinations of a job that are then the same query are only run once
+    """
+    queries = []
+    for job in jobs:
+        unknown = set(job) - set(FIELDS)
+        if unknown:
+            raise ValueError("Unknown job fields: " + ", ".join(sorted(unknown)))
+        if "file" not in job or "product" not in job:
+            raise ValueError("Every job needs a 'file' and a 'product'")
+        values = []
+        for field in FIELDS:
+            value = job.get(field, DEFAULTS.get(field))
+            values.append(value if isinstance(value, list) else [value])
+        seen = set()
+        for combination in itertools.product(*values):
+            query = dict(zip(FIELDS, combination))
+            query["product"] = _productCode(query["product"])
+            query["station"] = _stationNumber(query["station"])
+            if query["option"] in (1, 2, 3, 4):
+                query["window"] = None
+            identity = tuple([query[field] for field in FIELDS])
+            if identity in seen:
+                continue
+            seen.add(identity)
+            queries.append(query)
+    return queries
+
+def runBatch(queries):
+    """
+    Runs a list of queries from expandJobs and returns a list of result dictionaries
+    (keyed by RESULT_FIELDS, plus "aggregated" and "curve") in the same order
+    A query for every station (station None) gives one result per station, with
+    its station filled in
+    A query that fails or has no useable data gets no thresholds and the reason
+    in "error", and the other queries still run
+    """
+    datasets = {}       #file -> opened data
+    series = {}         #everything but option, window, frequency and mode -> {station: daily series} for option 5
+    aggregations = {}   #everything but frequency and mode -> {station: aggregated data}, or the error
+    frequencies = {}    #(aggregation, mode) -> every frequency asked for
+    invalid = {}        #position of a query -> the error
+    for position, query in enumerate(queries):
+        try:
+            _checkQuery(query)
+        except ValueError as error:
+            invalid[position] = _errorText(error)
+            continue
+        key = tuple([query[field] for field in FIELDS[:-2]])
+        if key not in aggregations:
+            try:
+                if os.path.isdir(query["file"]):
+                    import weather_archive
+                    filt = [query["product"], query["station"], None, query["month"], None, None, None, query["quality"]]
+                    datasets[query["file"]] = weather_archive.readArchive(query["file"], filt)
+                elif query["file"] not in datasets:
+                    datasets[query["file"]] = weather.openColumns(query["file"])
+                data = datasets[query["file"]]
+                if query["option"] == 5:
+                    #every run length is rolled from the same daily series
+                    seriesKey = tuple([query[field] for field in FIELDS[:6] if field != "option"])
+                    if seriesKey not in series:
+                        series[seriesKey] = weather.queryDailySeries(data, query["product"], query["station"],
+                                                                     query["month"], query["quality"])
+                    aggregations[key] = dict([(station, weather.rollingData(stationSeries, query["product"], query["window"]))
+                                              for station, stationSeries in series[seriesKey].items()])
+                elif query["station"] == None:
+                    aggregations[key] = weather.queryStations(data, query["product"], query["option"],
+                                                              query["month"], query["quality"], query["window"])
+                else:
+                    agg_data = weather.queryAggregate(data, query["product"], query["station"], query["option"],
+                                                      query["month"], query["quality"], query["window"])
+                    aggregations[key] = {query["station"]: agg_data} if agg_data else {}
+            except Exception as error:
+                aggregations[key] = _Failed(_errorText(error))
+        frequencies.setdefault((key, query["mode"]), set()).add(query["frequency"])
+
+    #one return-period curve answers every frequency of a station's aggregation and mode
+    curves = {}     #(aggregation, mode) -> {station: curve, or None without useable data}, or the error
+    for (key, mode), asked in frequencies.items():
+        if isinstance(aggregations[key], _Failed):
+            curves[(key, mode)] = aggregations[key]
+            continue
+        curves[(key, mode)] = {}
+        for station, agg_data in aggregations[key].items():
+            if all([x==None for x in agg_data.values()]):
+                curves[(key, mode)][station] = None
+                continue
+            try:
+                curves[(key, mode)][station] = weather.thresholdCurve(agg_data, sorted(asked), mode)
+            except Exception as error:
+                curves[(key, mode)] = _Failed(_errorText(error))
+                break
+
+    results = []
+    for position, query in enumerate(queries):
+        empty = dict(query, aggregated=None, curve=None, thresholdA=None, keysA=None,
+                     thresholdB=None, keysB=None, error=invalid.get(position))
+        if empty["error"] != None:
+            results.append(empty)
+            continue
+        key = tuple([query[field] for field in FIELDS[:-2]])
+        stationCurves = curves[(key, query["mode"])]
+        if isinstance(stationCurves, _Failed):
+            results.append(dict(empty, error=stationCurves.error))
+            continue
+        if stationCurves == {}:
+            results.append(dict(empty, error="No data fits the query"))
+            continue
+        for station, curve in stationCurves.items():
+            row = dict(empty, station=station, aggregated=aggregations[key][station], curve=curve)
+            results.append(row)
+            if curve == None:
+                row["error"] = "No useable data for this aggregation"
+                continue
+            point = curve[query["frequency"]]
+            for method in ("A", "B"):
+                threshold = point[method]
+                row["threshold" + method] = None if threshold == None else threshold[0]
+                row["keys" + method] = None if threshold == None else threshold[1]
+    return results
+
+class _Failed:
+    """
+    Stands in for an aggregation or curve that raised, with the error to report
+    """
+    def __init__(self, error):
+        self.error = error
+
+def _checkQuery(query):
+    """
+    Raises ValueError if a query from expandJobs can't be run
+    """
+    if type(query["frequency"]) != int or not 0 < query["frequency"] < 2000:
+        raise ValueError("frequency must be an integer between 0 and 2000")
+    if query["mode"] not in ("high", "low"):
+        raise ValueError("mode must be either 'high' or 'low'")
+    if query["option"] not in (1, 2, 3, 4, 5, 6):
+        raise ValueError("option must be 1, 2, 3, 4, 5 or 6")
+    if query["option"] == 5 and (type(query["window"]) != int or query["window"] < 1):
+        raise ValueError("option 5 needs a window of a whole number of days")
+    if query["option"] == 6:
+        weather.seasonWindow(query["window"])
+
+def _errorText(error):
+    return "%s: %s" % (type(error).__name__, error)
+
+def writeTable(results, f):
+    """
+    Writes runBatch's results to the open file "f" as a .csv table
+    """
+    writer = csv.writer(f)
+    writer.writerow(RESULT_FIELDS)
+    for row in results:
+        cells = []
+        for field in RESULT_FIELDS:
+            value = row[field]
+            if value == None:
+                value = ""
+            elif isinstance(value, list):
+                value = " ".join([str(x) for x in value])
+            cells.append(value)
+        writer.writerow(cells)
+
+def writeCharts(results, directory, workers=None):
+    """
+    Renders a chart of every result of runBatch into "directory", named by its
+    row number in the result table. Returns the paths written
+    """
+    import weather_render   #loads matplotlib
+    os.makedirs(directory, exist_ok=True)
+    charts = []
+    for number, row in enumerate(results, 1):
+        if row["thresholdB"] == None:
+            continue    #no useable data
+        title = "%s %s option %s 1 in %s %s" % (row["product"], row["station"], row["option"],
+                                                row["frequency"], row["mode"])
+        charts.append({"aggregated": row["aggregated"], "curve": row["curve"], "title": title,
+                       "thresholdA": None if row["thresholdA"] == None else (row["thresholdA"], row["keysA"]),
+                       "thresholdB": (row["thresholdB"], row["keysB"]),
+                       "path": os.path.join(directory, "%04d.png" % number)})
+    return weather_render.renderCharts(charts, workers)
+
+def _productCode(product):
+    if product in PRODUCTS.values():
+        return product
+    if str(product).lower() in PRODUCTS:
+        return PRODUCTS[str(product).lower()]
+    raise ValueError("Unknown product: " + str(product))
+
+def _stationNumber(station):
+    if station == None or isinstance(station, int):
+        return station
+    if str(station).lower() in STATIONS:
+        return STATIONS[str(station).lower()]
+    return int(station)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a job file of weather queries")
+    parser.add_argument("jobs", help="path to the JSON job file")
+    parser.add_argument("-o", "--output", help="path of the .csv table to write (default: standard output)")
+    parser.add_argument("--stats", help="write per-stage timings, rows and peak memory to this JSON file")
+    parser.add_argument("--metrics", help="write per-stage metrics to this Prometheus text file")
+    parser.add_argument("--profile", metavar="STAGE", help="profile one stage, eg. aggregateData")
+    parser.add_argument("--profiler", choices=["cprofile", "sampling"], default="cprofile")
+    parser.add_argument("--profile-output", help="file for the profile (default: STAGE.prof or STAGE.folded)")
+    parser.add_argument("--charts", metavar="DIR", help="render a .png chart of every query into this directory")
+    parser.add_argument("--chart-workers", type=int, help="processes rendering charts (default: all cores)")
+    args = parser.parse_args(argv)
+
+    if args.stats or args.metrics:
+        weather_instrument.enable(memory=True)
+    if args.profile:
+        weather_instrument.profile(args.profile, args.profiler, args.profile_output)
+    results = runBatch(expandJobs(readJobs(args.jobs)))
+    if args.stats:
+        weather_instrument.exportJson(args.stats)
+    if args.metrics:
+        weather_instrument.exportPrometheus(args.metrics)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writeTable(results, f)
+    else:
+        writeTable(results, sys.stdout)
+    if args.charts:
+        writeCharts(results, args.charts, args.chart_workers)
+
+if __name__ == "__main__":
+    main()
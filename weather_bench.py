@@ -0,0 +1,260 @@
+"""
+Benchmarks for the weather pipeline, on synthetic BOM data
+
+makeSyntheticCsv writes realistic IDCJAC0009 (rainfall) or IDCJAC0010
+(temperature) files: consecutive daily records for several stations, with
+missing days, multi-day accumulations in the Length column and a mix of
+quality flags. runBenchmarks times every stage of the pipeline on files of
+each size and reports time, peak memory and rows per second as JSON, and
+compareResults flags stages that got slower than a saved run. runStartup times
+how long a fresh interpreter takes to import weather and answer a small query.
+
+Usage: python weather_bench.py [--sizes 1e3,1e4,1e5,1e6] [--startup] [-o results.json] [--compare baseline.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import weather
+
+HEADERS = {
+    "IDCJAC0009": "Product code,Bureau of Meteorology station number,Year,Month,Day,"
+                  "Rainfall amount (millimetres),Period over which rainfall was measured (days),Quality",
+    "IDCJAC0010": "Product code,Bureau of Meteorology station number,Year,Month,Day,"
+                  "Maximum temperature (Degree C),Days of accumulation of maximum temperature,Quality",
+}
+
+def makeSyntheticCsv(path, rows, code="IDCJAC0009", stations=3, startYear=1900, missingRate=0.02,
+                     accumulationRate=0.01, qualityRate=0.9, seed=0):
+    """
+    Writes a BOM .csv file of "rows" daily observations, split evenly between
+    "stations" stations that each report every day from 1 January "startYear"
+        missingRate - fraction of days with a blank measurement
+        accumulationRate - fraction of days that end a 2 to 4 day accumulation:
+            the days before are blank and the day holds the total, with its Length
+        qualityRate - fraction of observations flagged 'Y' rather than 'N'
+    Rainfall is mostly dry days with exponential falls, temperature is seasonal
+    """
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as f:
+        f.write(HEADERS[code] + "\n")
+        for station in range(stations):
+            count = rows//stations + (1 if station < rows%stations else 0)
+            if count == 0:
+                continue
+            first = np.datetime64(str(startYear) + "-01-01")
+            dates = first + np.arange(count)
+            year = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+            month = dates.astype("datetime64[M]").astype(np.int64)%12 + 1
+            day = (dates - dates.astype("datetime64[M]")).astype(np.int64) + 1
+            dayOfYear = (dates - dates.astype("datetime64[Y]")).astype(np.int64)
+
+            if code == "IDCJAC0009":
+                wet = rng.random(count) < 0.35
+                value = np.where(wet, np.round(rng.exponential(6.0, count), 1), 0.0)
+            else:
+                seasonal = 20 + 8*np.cos(2*np.pi*dayOfYear/365.25)
+                value = np.round(seasonal + rng.normal(0, 4, count), 1)
+            length = np.where(value > 0, 1, 0) if code == "IDCJAC0009" else np.ones(count, dtype=np.int64)
+
+            #multi-day accumulations: the total lands on the last day
+            ends = np.flatnonzero(rng.random(count) < accumulationRate)
+            spans = rng.integers(2, 5, len(ends))
+            blank = np.zeros(count, dtype=bool)
+            for end, span in zip(ends.tolist(), spans.tolist()):
+                if end - span + 1 < 0:
+                    continue
+                value[end] = np.round(value[end - span + 1:end + 1].sum(), 1) if code == "IDCJAC0009" else value[end]
+                length[end] = span
+                blank[end - span + 1:end] = True
+            blank |= rng.random(count) < missingRate
+            quality = np.where(rng.random(count) < qualityRate, "Y", "N")
+
+            stationId = "%06d" % (70000 + station)
+            lines = []
+            for y, m, d, v, l, q, b in zip(year.tolist(), month.tolist(), day.tolist(), value.tolist(),
+                                           length.tolist(), quality.tolist(), blank.tolist()):
+                if b:
+                    lines.append("%s,%s,%d,%02d,%02d,,,\n" % (code, stationId, y, m, d))
+                else:
+                    lines.append("%s,%s,%d,%02d,%02d,%.1f,%s,%s\n" % (code, stationId, y, m, d, v, l if l else "", q))
+                if len(lines) >= 100000:
+                    f.writelines(lines)
+                    lines = []
+            f.writelines(lines)
+
+def runBenchmarks(sizes, code="IDCJAC0009", dataDir=None, memory=True, listLimit=10**6, frequency=20, repeat=1):
+    """
+    Times every stage of the pipeline on synthetic files of each size in "sizes" (rows)
+    Returns a list of results, one per stage and size:
+        {"stage", "option", "rows", "rowsOut", "seconds", "rowsPerSecond", "peakBytes"}
+    "seconds" is the best of "repeat" runs. "peakBytes" is the peak traced by
+    tracemalloc in a separate run (None unless "memory")
+    openData and the list-of-lists filterData are skipped above "listLimit" rows
+    """
+    if dataDir == None:
+        dataDir = os.path.join(tempfile.gettempdir(), "weather_bench")
+    os.makedirs(dataDir, exist_ok=True)
+
+    results = []
+    for rows in sizes:
+        path = os.path.join(dataDir, "%s_%d.csv" % (code, rows))
+        if not os.path.isfile(path):
+            makeSyntheticCsv(path, rows, code)
+        filt = [code, 70000, None, None, None, None, None, None]
+
+        stages = []
+        if rows <= listLimit:
+            stages.append(("openData", None, lambda: weather.openData(path)))
+        stages.append(("openColumns", None, lambda: weather.openColumns(path, cache=False)))
+        data = weather.openColumns(path, cache=False)
+        if rows <= listLimit:
+            listData = weather.openData(path)
+            stages.append(("filterData", "lists", lambda: weather.filterData(listData, filt)))
+        stages.append(("filterData", "columns", lambda: weather.filterData(data, filt)))
+        clean_data = weather.filterData(data, filt)
+        for option in (1, 2, 3, 4):
+            stages.append(("aggregateData", option, lambda option=option: weather.aggregateData(clean_data, code, option)))
+        for option in (1, 3, 4):
+            agg_data = weather.aggregateData(clean_data, code, option)
+            if all([x==None for x in agg_data.values()]):
+                continue
+            stages.append(("calcThresholdA", option, lambda agg_data=agg_data: weather.calcThresholdA(agg_data, frequency, "high")))
+            stages.append(("calcThresholdB", option, lambda agg_data=agg_data: weather.calcThresholdB(agg_data, frequency, "high")))
+
+        for stage, option, run in stages:
+            best = None
+            for attempt in range(repeat):
+                start = time.perf_counter()
+                output = run()
+                seconds = time.perf_counter() - start
+                best = seconds if best == None else min(best, seconds)
+            peak = None
+            if memory:
+                output = None
+                tracemalloc.start()
+                output = run()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results.append({"stage": stage, "option": option, "rows": rows, "rowsOut": _rowsOut(output),
+                            "seconds": best, "rowsPerSecond": rows/best if best > 0 else None,
+                            "peakBytes": peak})
+            output = None
+    return results
+
+#Run in a fresh interpreter by runStartup. Prints the seconds taken to import
+#weather and to get the first result, as JSON
+_STARTUP_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import weather
+imported = time.perf_counter()
+weather.runQuery(sys.argv[1], sys.argv[2], 70000, 3, 20, "high")
+answered = time.perf_counter()
+print(json.dumps({"import": imported - start, "firstResult": answered - start}))
+"""
+
+def runStartup(rows=1000, code="IDCJAC0009", dataDir=None, repeat=5):
+    """
+    Times the startup of a small query: a new Python process imports weather and
+    runs one runQuery on a synthetic file of "rows" rows (warm in the on-disk cache)
+    Returns results like runBenchmarks', for the stages
+        "import" - importing weather
+        "firstResult" - importing weather and answering the query
+        "process" - the whole process, interpreter start up included
+    each the best of "repeat" processes
+    """
+    if dataDir == None:
+        dataDir = os.path.join(tempfile.gettempdir(), "weather_bench")
+    os.makedirs(dataDir, exist_ok=True)
+    path = os.path.join(dataDir, "%s_%d.csv" % (code, rows))
+    if not os.path.isfile(path):
+        makeSyntheticCsv(path, rows, code)
+    weather.openColumns(path)   #fill the cache, so every run below is warm
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([here] + [x for x in [os.environ.get("PYTHONPATH")] if x]))
+    best = {}
+    for attempt in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, path, code], env=environment,
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        seconds = dict(json.loads(output.strip().splitlines()[-1]), process=time.perf_counter() - start)
+        for stage in ("import", "firstResult", "process"):
+            best[stage] = seconds[stage] if stage not in best else min(best[stage], seconds[stage])
+    return [{"stage": stage, "option": "startup", "rows": rows, "rowsOut": None, "seconds": best[stage],
+             "rowsPerSecond": None, "peakBytes": None} for stage in ("import", "firstResult", "process")]
+
+def compareResults(results, baseline, tolerance=0.2):
+    """
+    Returns the results that are more than "tolerance" (a fraction) slower than
+    the matching stage, option and size of a baseline run, with the baseline's
+    time in "baselineSeconds"
+    """
+    previous = {}
+    for result in baseline:
+        previous[(result["stage"], str(result["option"]), result["rows"])] = result["seconds"]
+    slower = []
+    for result in results:
+        before = previous.get((result["stage"], str(result["option"]), result["rows"]))
+        if before != None and result["seconds"] > before*(1 + tolerance):
+            slower.append(dict(result, baselineSeconds=before))
+    return slower
+
+def _rowsOut(output):
+    if output == None:
+        return None
+    if isinstance(output, tuple):   #a threshold and its keys
+        return len(output[1])
+    if isinstance(output, dict) and "levels" not in output:
+        return len(output)
+    return weather.countRows(output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the weather pipeline on synthetic data")
+    parser.add_argument("--sizes", default="1e3,1e4,1e5,1e6",
+                        help="comma separated row counts (default: 1e3,1e4,1e5,1e6)")
+    parser.add_argument("--product", default="IDCJAC0009", choices=sorted(HEADERS))
+    parser.add_argument("--data-dir", help="where the synthetic files are kept (default: a temporary directory)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc peak memory runs")
+    parser.add_argument("--list-limit", type=float, default=1e6,
+                        help="largest size to run the list-of-lists stages on (default: 1e6)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the best is kept")
+    parser.add_argument("--startup", action="store_true",
+                        help="also time importing weather and answering a small query in a new process")
+    parser.add_argument("-o", "--output", help="path of the JSON results (default: standard output)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed by --compare (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(float(size)) for size in args.sizes.split(",")]
+    results = runBenchmarks(sizes, args.product, args.data_dir, not args.no_memory,
+                            int(args.list_limit), repeat=args.repeat)
+    if args.startup:
+        results.extend(runStartup(code=args.product, dataDir=args.data_dir, repeat=max(args.repeat, 5)))
+    report = {"python": platform.python_version(), "numpy": np.__version__,
+              "machine": platform.platform(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            slower = compareResults(results, json.load(f)["results"], args.tolerance)
+        for result in slower:
+            print("SLOWER:", result["stage"], "option", result["option"], result["rows"], "rows:",
+                  "%.4fs (was %.4fs)" % (result["seconds"], result["baselineSeconds"]), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
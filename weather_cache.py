@@ -0,0 +1,179 @@
+"""
+On-disk cache of parsed BOM files, used by weather.openColumns
+
+Each parsed file is stored as one .npy file per column, so a warm run
+memory-maps the columns instead of parsing the .csv again. Entries are
+keyed by the content hash of the source file, and a small fingerprint file
+maps (path, size, mtime) to that hash so unchanged files are never re-read.
+Editing a file changes its fingerprint, which forces a re-hash and a new entry.
+
+Layout of the cache directory:
+    fingerprints/<fingerprint>.json - {"path", "size", "mtime", "hash"}
+    entries/<hash>/<column>.npy     - the parsed columns
+    entries/<hash>/levels.json      - the categorical levels
+
+Entries are written to a temporary directory and renamed into place, and are
+renamed out of place before they are deleted, so several processes can fill
+and evict the cache at once without ever seeing half an entry.
+The cache is capped at CACHE_SIZE bytes; the least recently used entries go first.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+CACHE_DIR = os.environ.get("WEATHER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "weather"))
+CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", 1 << 30))    #bytes
+
+def loadCached(path, parse, version, cacheDir=None, sizeLimit=None):
+    """
+    Returns parse(path), reading it from the cache if "path" has been parsed before
+    "parse" must return a dictionary of 1-D NumPy arrays plus a "levels" entry
+    of {name: [str, ...]}. Cached arrays come back as read-only memory maps
+    "version" names the layout parse produces, so changing it invalidates old entries
+    "cacheDir" and "sizeLimit" default to CACHE_DIR and CACHE_SIZE
+    """
+    if cacheDir == None:
+        cacheDir = CACHE_DIR
+    if sizeLimit == None:
+        sizeLimit = CACHE_SIZE
+
+    stat = os.stat(path)
+    fingerprint = _fingerprint(path, stat, version)
+    fingerprintPath = os.path.join(cacheDir, "fingerprints", fingerprint + ".json")
+
+    #Warm path - the file hasn't changed since it was last seen
+    try:
+        with open(fingerprintPath, "r") as f:
+            digest = json.load(f)["hash"]
+        return _loadEntry(os.path.join(cacheDir, "entries", digest))
+    except (OSError, ValueError, KeyError):
+        pass
+
+    #The file is new or has been touched. Its content may still be cached
+    digest = _contentHash(path, version)
+    entry = os.path.join(cacheDir, "entries", digest)
+    try:
+        data = _loadEntry(entry)
+    except (OSError, ValueError, KeyError):
+        data = parse(path)
+        if _unchanged(path, stat):  #don't cache a file that changed while it was parsed
+            _writeEntry(entry, data)
+            _evict(cacheDir, sizeLimit, keep=digest)
+    _writeJson(fingerprintPath, {"path": os.path.abspath(path), "size": stat.st_size,
+                                 "mtime": stat.st_mtime_ns, "hash": digest})
+    return data
+
+def clearCache(cacheDir=None):
+    """
+    Removes every entry and fingerprint from the cache
+    """
+    if cacheDir == None:
+        cacheDir = CACHE_DIR
+    _evict(cacheDir, 0)
+    shutil.rmtree(os.path.join(cacheDir, "fingerprints"), ignore_errors=True)
+
+def _fingerprint(path, stat, version):
+    key = "|".join([version, os.path.abspath(path), str(stat.st_size), str(stat.st_mtime_ns)])
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+def _contentHash(path, version):
+    digest = hashlib.blake2b(version.encode("utf-8"), digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def _unchanged(path, stat):
+    now = os.stat(path)
+    return now.st_size == stat.st_size and now.st_mtime_ns == stat.st_mtime_ns
+
+def _loadEntry(entry):
+    """
+    Memory-maps a cached entry, and marks it as recently used
+    """
+    import numpy as np
+    with open(os.path.join(entry, "levels.json"), "r") as f:
+        meta = json.load(f)
+    data = {"levels": meta["levels"]}
+    for name in meta["columns"]:
+        data[name] = np.load(os.path.join(entry, name + ".npy"), mmap_mode="r")
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return data
+
+def _writeEntry(entry, data):
+    import numpy as np
+    entries = os.path.dirname(entry)
+    os.makedirs(entries, exist_ok=True)
+    temporary = tempfile.mkdtemp(prefix=".tmp-", dir=entries)
+    try:
+        columns = [name for name in data if name != "levels"]
+        for name in columns:
+            np.save(os.path.join(temporary, name + ".npy"), np.ascontiguousarray(data[name]))
+        with open(os.path.join(temporary, "levels.json"), "w") as f:
+            json.dump({"columns": columns, "levels": data["levels"]}, f)
+        os.rename(temporary, entry)
+    except OSError:
+        #another process got there first (or the disk is full) - the cache is only a cache
+        shutil.rmtree(temporary, ignore_errors=True)
+
+def _writeJson(path, value):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+        with os.fdopen(descriptor, "w") as f:
+            json.dump(value, f)
+        os.replace(temporary, path)
+    except OSError:
+        pass
+
+def _evict(cacheDir, sizeLimit, keep=None):
+    """
+    Deletes the least recently used entries until the cache fits in "sizeLimit" bytes
+    Never deletes the entry "keep"
+    """
+    entries = os.path.join(cacheDir, "entries")
+    try:
+        names = os.listdir(entries)
+    except OSError:
+        return
+    found = []
+    total = 0
+    for name in names:
+        entry = os.path.join(entries, name)
+        try:
+            size = sum([os.path.getsize(os.path.join(entry, x)) for x in os.listdir(entry)])
+            lastUsed = os.stat(entry).st_mtime
+        except OSError:
+            continue    #being written or evicted by another process
+        if name.startswith(".tmp-"):
+            #left behind by a process that died mid-write
+            if time.time() - lastUsed > 3600:
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        found.append((lastUsed, name, size))
+        total += size
+
+    found.sort()
+    for lastUsed, name, size in found:
+        if total <= sizeLimit:
+            break
+        if name == keep:
+            continue
+        #rename first, so readers either see the whole entry or none of it
+        trash = os.path.join(entries, ".tmp-evicted-" + name + "-" + str(os.getpid()))
+        try:
+            os.rename(os.path.join(entries, name), trash)
+        except OSError:
+            continue
+        shutil.rmtree(trash, ignore_errors=True)
+        total -= size
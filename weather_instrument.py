@@ -0,0 +1,233 @@
+"""
+Per-stage instrumentation for the weather pipeline
+
+The stages of weather.py (openData, filterData, aggregateData, the threshold
+calculations, displayGraph, ...) are wrapped with stage(). While instrumentation
+is off a wrapped call costs one flag check. After enable() every call records
+its wall time, rows in and rows out, plus the peak memory traced by tracemalloc
+if enable(memory=True). records() returns the calls, summary() totals them per
+stage, and exportJson()/exportPrometheus() write them to files.
+
+profile() is an opt-in hook that runs one stage under cProfile, or under a
+sampling profiler that writes folded stacks (the input of flamegraph tools).
+
+    import weather, weather_instrument
+    weather_instrument.enable(memory=True)
+    weather_instrument.profile("aggregateData", "sampling", "aggregate.folded")
+    weather.runQuery(...)
+    weather_instrument.exportPrometheus("weather.prom")
+"""
+import sys
+import json
+import time
+import cProfile
+import functools
+import threading
+import collections
+import tracemalloc
+
+_enabled = False
+_memory = False
+_records = []
+_profilers = {}     #stage -> profiler
+_peaks = []         #highest traced memory so far of each stage call in progress, outermost first
+
+def enable(memory=False):
+    """
+    Starts recording every stage call. "memory" also records each stage's
+    peak traced memory, which slows Python-heavy stages down noticeably
+    """
+    global _enabled, _memory
+    _enabled = True
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    """
+    Stops recording. Records already made are kept
+    """
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _memory = False
+
+def reset():
+    """
+    Forgets every record
+    """
+    del _records[:]
+
+def records():
+    """
+    Returns a list of every recorded call, oldest first:
+        {"stage", "seconds", "rowsIn", "rowsOut", "peakBytes", "started"}
+    "rowsIn"/"rowsOut" are None where the argument or result isn't a dataset,
+    and "peakBytes" is None unless memory is recorded
+    """
+    return list(_records)
+
+def summary():
+    """
+    Returns the records totalled per stage, in the order stages first ran:
+        {stage: {"calls", "seconds", "rowsIn", "rowsOut", "peakBytes"}}
+    "peakBytes" is the largest peak of any call
+    """
+    totals = collections.OrderedDict()
+    for record in _records:
+        total = totals.setdefault(record["stage"], {"calls": 0, "seconds": 0.0, "rowsIn": 0,
+                                                    "rowsOut": 0, "peakBytes": None})
+        total["calls"] += 1
+        total["seconds"] += record["seconds"]
+        total["rowsIn"] += record["rowsIn"] or 0
+        total["rowsOut"] += record["rowsOut"] or 0
+        if record["peakBytes"] != None:
+            total["peakBytes"] = max(total["peakBytes"] or 0, record["peakBytes"])
+    return totals
+
+def exportJson(path):
+    """
+    Writes the records and their per-stage summary to "path" as JSON
+    """
+    with open(path, "w") as f:
+        json.dump({"records": records(), "summary": summary()}, f, indent=1)
+
+def exportPrometheus(path):
+    """
+    Writes the per-stage summary to "path" in the Prometheus text format
+    """
+    metrics = [
+        ("weather_stage_calls_total", "counter", "Calls of each pipeline stage", "calls"),
+        ("weather_stage_seconds_total", "counter", "Wall time spent in each pipeline stage", "seconds"),
+        ("weather_stage_rows_in_total", "counter", "Rows passed into each pipeline stage", "rowsIn"),
+        ("weather_stage_rows_out_total", "counter", "Rows returned by each pipeline stage", "rowsOut"),
+        ("weather_stage_peak_bytes", "gauge", "Largest peak traced memory of one call of each stage", "peakBytes"),
+    ]
+    totals = summary()
+    lines = []
+    for name, kind, description, field in metrics:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for stageName, total in totals.items():
+            if total[field] != None:
+                lines.append('%s{stage="%s"} %s' % (name, stageName, repr(total[field])))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def profile(stageName, kind="cprofile", output=None, interval=0.001):
+    """
+    Profiles every later call of one stage, whether or not instrumentation is enabled
+        kind - "cprofile", or "sampling" for a sampling profiler that looks at the
+            stack every "interval" seconds
+        output - file written after each call: pstats data for cProfile (read it with
+            the pstats module), folded stacks for sampling. Defaults to <stage>.prof/.folded
+    Calls accumulate into the same profile. profile(stageName, None) stops profiling
+    """
+    if kind == None:
+        _profilers.pop(stageName, None)
+    elif kind == "cprofile":
+        _profilers[stageName] = _CProfiler(output or stageName + ".prof")
+    elif kind == "sampling":
+        _profilers[stageName] = _SamplingProfiler(output or stageName + ".folded", interval)
+    else:
+        raise ValueError("kind must be 'cprofile', 'sampling' or None")
+
+def stage(stageName):
+    """
+    Decorator that makes a function a recorded (and profilable) stage called "stageName"
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            if not _enabled and not _profilers:
+                return function(*args, **kwargs)
+            profiler = _profilers.get(stageName)
+            if not _enabled:
+                if profiler == None:
+                    return function(*args, **kwargs)
+                return profiler.run(function, args, kwargs)
+            if _memory:
+                #resetting the peak would lose the enclosing stage's, so it is kept on _peaks
+                if _peaks:
+                    _peaks[-1] = max(_peaks[-1], tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                _peaks.append(before)
+            started = time.time()
+            start = time.perf_counter()
+            try:
+                if profiler == None:
+                    result = function(*args, **kwargs)
+                else:
+                    result = profiler.run(function, args, kwargs)
+            finally:
+                if _memory:
+                    highest = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                    if _peaks:
+                        _peaks[-1] = max(_peaks[-1], highest)
+            seconds = time.perf_counter() - start
+            peak = None
+            if _memory:
+                peak = highest - before
+            _records.append({"stage": stageName, "seconds": seconds, "rowsIn": _rows(args[0]) if args else None,
+                             "rowsOut": _rows(result), "peakBytes": peak, "started": started})
+            return result
+        return instrumented
+    return decorate
+
+def _rows(value):
+    """
+    The number of rows of a dataset (openData's lists, openColumns' columns, or aggregated data)
+    """
+    if isinstance(value, dict):
+        if "levels" in value:
+            return len(value["year"])
+        if "day" in value and "total" in value:     #a weather.dailySeries
+            return len(value["day"])
+        return len(value)
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+class _CProfiler:
+    def __init__(self, output):
+        self.output = output
+        self.profiler = cProfile.Profile()
+
+    def run(self, function, args, kwargs):
+        try:
+            return self.profiler.runcall(function, *args, **kwargs)
+        finally:
+            self.profiler.dump_stats(self.output)
+
+class _SamplingProfiler:
+    def __init__(self, output, interval):
+        self.output = output
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def run(self, function, args, kwargs):
+        target = threading.get_ident()
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                frame = sys._current_frames().get(target)
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            done.set()
+            sampler.join()
+            with open(self.output, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
@@ -0,0 +1,147 @@
+"""
+Runs the weather pipeline (open -> filterData -> aggregateData -> thresholds)
+over many station files at once, one file per worker process
+
+Sources are either paths, which each worker opens itself (through the
+on-disk cache, so nothing large crosses between processes), or data that is
+already open in this process. Open data is copied once into shared memory and
+the workers map it, rather than having it pickled to them.
+Results come back in the order of the sources, and an error in one source is
+reported in its result instead of stopping the others.
+
+Usage: python weather_parallel.py rainfall 1 20 high file1.csv file2.csv ... [-w workers] [--station N]
+"""
+import os
+import argparse
+import traceback
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+import weather
+
+def runParallel(sources, code, station=None, option=1, frequency=20, mode='high', month=None,
+                quality=None, window=None, workers=None):
+    """
+    Runs the same query (see weather.runQuery) over every source
+    "sources" is a list of file paths and/or data from weather.openColumns
+    "workers" is the number of processes, os.cpu_count() by default
+    Returns a list with one dictionary per source, in the same order:
+        "source" - the path, or the position of the source in "sources" for open data
+        "thresholdA", "thresholdB" - as returned by weather.runQuery
+        "aggregated" - the aggregated data
+        "stations" - with station None, weather.runQuery's {station: {"aggregated",
+            "thresholdA", "thresholdB"}} for every station of the source instead
+        "error" - None, or the traceback of the exception that stopped this source
+    """
+    query = (code, station, option, frequency, mode, month, quality, window)
+    if workers == None:
+        workers = os.cpu_count()
+    shared = []
+    results = []
+    try:
+        tasks = []
+        for position, source in enumerate(sources):
+            if isinstance(source, dict):
+                blocks, layout = shareColumns(source)
+                shared.extend(blocks)
+                tasks.append((position, layout))
+            else:
+                tasks.append((source, None))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_runSource, source, layout, query) for source, layout in tasks]
+            for future in futures:
+                results.append(future.result())
+    finally:
+        for block in shared:
+            block.close()
+            block.unlink()
+    return results
+
+def shareColumns(data):
+    """
+    Copies the columns of weather.openColumns' data into shared memory blocks
+    Returns (blocks, layout). "layout" is small enough to pickle and is turned back
+    into data by attachColumns. The caller must close() and unlink() the blocks
+    """
+    blocks = []
+    layout = {"levels": data["levels"], "columns": {}}
+    for name in weather.COLUMNS:
+        column = np.ascontiguousarray(data[name])
+        block = shared_memory.SharedMemory(create=True, size=max(column.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(column.shape, column.dtype, buffer=block.buf)[:] = column
+        layout["columns"][name] = (block.name, column.shape, column.dtype.str)
+    return blocks, layout
+
+def attachColumns(layout):
+    """
+    Maps the shared memory blocks of shareColumns' layout back into weather.openColumns' data
+    Returns (data, blocks); close() the blocks once the data is no longer needed
+    """
+    blocks = []
+    data = {"levels": layout["levels"]}
+    for name, (blockName, shape, dtype) in layout["columns"].items():
+        block = shared_memory.SharedMemory(name=blockName)
+        blocks.append(block)
+        data[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+    return data, blocks
+
+def _runSource(source, layout, query):
+    """
+    Runs the query over one source in a worker process
+    """
+    code, station, option, frequency, mode, month, quality, window = query
+    result = {"source": source, "aggregated": None, "thresholdA": None, "thresholdB": None,
+              "stations": None, "error": None}
+    blocks = []
+    try:
+        if layout == None:
+            data = weather.openColumns(source)
+        else:
+            data, blocks = attachColumns(layout)
+        if station == None:
+            stations = weather.queryStations(data, code, option, month, quality, window)
+            result["stations"] = weather.queryStationThresholds(stations, frequency, mode)
+        else:
+            agg_data = weather.queryAggregate(data, code, station, option, month, quality, window)
+            result.update(weather.queryThresholds(agg_data, frequency, mode))
+    except Exception:
+        result["error"] = traceback.format_exc()
+    finally:
+        data = None     #drop the views before the blocks are closed
+        for block in blocks:
+            block.close()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one weather query over many station files in parallel")
+    parser.add_argument("product", help="rainfall or temperature")
+    parser.add_argument("option", type=int, help="aggregation option (see weather.aggregateData)")
+    parser.add_argument("frequency", type=int, help="how rare the event is, eg. 20 for 1 in 20")
+    parser.add_argument("mode", choices=["high", "low"])
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-w", "--workers", type=int, help="number of worker processes (default: all cores)")
+    parser.add_argument("--station", type=int, help="station number (default: every station, each on its own)")
+    parser.add_argument("--month", type=int)
+    parser.add_argument("--quality", action="store_const", const="Y", help="require quality assured data")
+    parser.add_argument("--window", type=int, help="run length in days for option 5")
+    args = parser.parse_args(argv)
+
+    code = "IDCJAC0009" if args.product.lower().startswith("rain") else "IDCJAC0010"
+    results = runParallel(args.files, code, args.station, args.option, args.frequency, args.mode, args.month,
+                          args.quality, args.window, args.workers)
+    for result in results:
+        if result["error"] != None:
+            print(result["source"], "failed:", result["error"].strip().splitlines()[-1])
+        elif result["stations"] != None:
+            if result["stations"] == {}:
+                print(result["source"], "has no data that fits the query")
+            for station, thresholds in result["stations"].items():
+                print(result["source"], "station", station, "calcThresholdA result:", thresholds["thresholdA"],
+                      "calcThresholdB result:", thresholds["thresholdB"])
+        else:
+            print(result["source"], "calcThresholdA result:", result["thresholdA"],
+                  "calcThresholdB result:", result["thresholdB"])
+
+if __name__ == "__main__":
+    main()
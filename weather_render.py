@@ -0,0 +1,154 @@
+"""
+Headless chart rendering for the weather pipeline
+
+ChartRenderer draws the same chart as weather.displayGraph - the aggregated
+series with a line at each threshold, and optionally the return-period curve -
+straight to PNG or SVG files, without pyplot or a display. One renderer keeps
+its figure, axes and artists and only swaps their data between charts. Series
+longer than the pixel budget are reduced to the min and max of each pixel
+column, which keeps every peak a threshold line could be compared against, and
+only a readable number of tick labels is drawn. renderCharts renders a batch
+of charts over several worker processes, each with its own renderer.
+
+    renderer = ChartRenderer()
+    renderer.render(agg_data, thresholdA, thresholdB, "chart.png", curve=curve)
+"""
+import os
+import concurrent.futures
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.ticker import NullLocator
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+class ChartRenderer:
+    """
+    Renders charts into files, reusing one figure and its artists
+        width, height - size of the image in pixels
+        pixelBudget - most points drawn per series (the plot width by default)
+        tickSpacing - least number of pixels between tick labels
+    """
+    def __init__(self, width=1200, height=500, dpi=100, pixelBudget=None, tickSpacing=60):
+        self.width = width
+        self.dpi = dpi
+        self.pixelBudget = pixelBudget
+        self.tickSpacing = tickSpacing
+        self.figure = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.seriesAxes = self.figure.add_axes([0.06, 0.2, 0.62, 0.72])
+        self.curveAxes = self.figure.add_axes([0.75, 0.2, 0.22, 0.72])
+        self.series, = self.seriesAxes.plot([], [], color='blue', drawstyle='steps-mid', linewidth=0.8)
+        self.lineA = self.seriesAxes.axhline(0, linestyle='--', color='r')
+        self.lineB = self.seriesAxes.axhline(0, linestyle='--', color='g')
+        self.curveA, = self.curveAxes.plot([], [], "o-r", label="Method A")
+        self.curveB, = self.curveAxes.plot([], [], "s-g", label="Method B")
+        self.curveAxes.set_xscale("log")
+        self.curveAxes.xaxis.set_minor_locator(NullLocator())
+        self.curveAxes.set_xlabel("1 in F")
+        self.curveAxes.legend()
+        self.title = self.seriesAxes.set_title("")
+
+    def render(self, agg_data, method_A_threshold, method_B_threshold, path, curve=None, title=None):
+        """
+        Draws aggregated data with its thresholds (calcThresholdA/calcThresholdB results,
+        either may be None) and writes it to "path". The format follows the extension
+        (.png, .svg, ...). "curve" is an optional return-period curve from thresholdCurve
+        """
+        keys = list(agg_data.keys())
+        y = np.array([0.0 if value == None else value for value in agg_data.values()])  #holes at 0
+        budget = self.pixelBudget or int(self.width*0.62)
+        x, y = downsample(y, budget)
+        self.series.set_data(x, y)
+
+        for line, threshold in ((self.lineA, method_A_threshold), (self.lineB, method_B_threshold)):
+            line.set_visible(threshold != None)
+            if threshold != None:
+                line.set_ydata([threshold[0], threshold[0]])
+
+        axes = self.seriesAxes
+        axes.set_xlim(-0.5, max(len(keys), 1) - 0.5)
+        levels = [value for value in y.tolist()] + [t[0] for t in (method_A_threshold, method_B_threshold) if t != None]
+        low, high = (min(levels), max(levels)) if levels else (0, 1)
+        margin = (high - low)*0.05 or 1
+        axes.set_ylim(min(low, 0) - margin, high + margin)
+        ticks = thinTicks(len(keys), int(self.width*0.62)//self.tickSpacing)
+        axes.set_xticks(ticks)
+        axes.set_xticklabels([str(keys[i]) for i in ticks], rotation=90)
+        self.title.set_text(title or "")
+
+        self.curveAxes.set_visible(curve != None)
+        if curve != None:
+            for line, method in ((self.curveA, "A"), (self.curveB, "B")):
+                points = [(F, curve[F][method][0]) for F in sorted(curve) if curve[F][method] != None]
+                line.set_data([F for F, threshold in points], [threshold for F, threshold in points])
+            self.curveAxes.set_xticks(sorted(curve))
+            self.curveAxes.set_xticklabels([str(F) for F in sorted(curve)])
+            self.curveAxes.relim()
+            self.curveAxes.autoscale_view()
+
+        self.figure.savefig(path, dpi=self.dpi)
+        return path
+
+def downsample(y, budget):
+    """
+    Returns (x, y) for drawing the series "y" in at most about "budget" points:
+    series that are longer are cut into "budget" buckets, each drawn as its
+    smallest and largest value in the order they occur
+    """
+    n = len(y)
+    if n <= 2*budget:
+        return np.arange(n), y
+    edges = np.linspace(0, n, budget + 1).astype(np.int64)
+    starts = edges[:-1]
+    low = np.minimum.reduceat(y, starts)
+    high = np.maximum.reduceat(y, starts)
+    lowAt = starts + np.array([np.argmin(y[a:b]) for a, b in zip(starts, edges[1:])])
+    highAt = starts + np.array([np.argmax(y[a:b]) for a, b in zip(starts, edges[1:])])
+    first = lowAt <= highAt
+    x = np.column_stack([np.where(first, lowAt, highAt), np.where(first, highAt, lowAt)]).ravel()
+    values = np.column_stack([np.where(first, low, high), np.where(first, high, low)]).ravel()
+    return x, values
+
+def thinTicks(count, most):
+    """
+    Positions of at most "most" evenly spaced tick labels for a series of "count" points
+    """
+    if count == 0:
+        return []
+    step = max(1, int(np.ceil(count/max(most, 1))))
+    return list(range(0, count, step))
+
+_renderer = None    #the renderer of this process, made on first use
+
+def renderChart(agg_data, method_A_threshold, method_B_threshold, path, curve=None, title=None, **options):
+    """
+    ChartRenderer.render on this process's renderer. "options" only apply to its first call
+    """
+    global _renderer
+    if _renderer == None:
+        _renderer = ChartRenderer(**options)
+    return _renderer.render(agg_data, method_A_threshold, method_B_threshold, path, curve, title)
+
+def _renderChunk(charts, options):
+    return [renderChart(chart["aggregated"], chart.get("thresholdA"), chart.get("thresholdB"),
+                        chart["path"], chart.get("curve"), chart.get("title"), **options) for chart in charts]
+
+def renderCharts(charts, workers=None, **options):
+    """
+    Renders a list of charts, each a dictionary of "aggregated", "path" and optionally
+    "thresholdA", "thresholdB", "curve" and "title" (see ChartRenderer.render)
+    The charts are split between "workers" processes (os.cpu_count() by default);
+    "options" are passed to each worker's ChartRenderer
+    Returns the paths written, in order
+    """
+    if workers == None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(charts)))
+    if workers == 1:
+        return _renderChunk(charts, options)
+    chunks = [charts[i::workers] for i in range(workers)]
+    paths = [None]*len(charts)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_renderChunk, chunk, options) for chunk in chunks]
+        for i, future in enumerate(futures):
+            paths[i::workers] = future.result()
+    return paths
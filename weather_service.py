@@ -0,0 +1,317 @@
+"""
+Local HTTP/JSON query service for the weather pipeline
+
+Serves the same queries as the interactive program without the prompts. The
+datasets given on the command line are parsed once and kept in memory (they
+are re-opened if the file changes), so a query only filters, aggregates and
+finds thresholds. The threshold calculations run on a pool of worker
+processes, identical queries that arrive while one is running share its
+result, and finished results are kept in an LRU cache with a size and age limit.
+
+    GET /query?product=rain&station=canberra&option=1&frequency=20&mode=high
+        product, station - as in a weather_batch job; station defaults to "all", which
+            answers with "stations": {station: {"thresholdA", "thresholdB"}, ...} for
+            every station in the dataset instead of one pair of thresholds
+        option, month, quality, window, frequency, mode - as in a weather_batch job
+        file - which dataset, by path or file name (optional if only one is served)
+        aggregated=1 - also return the aggregated series
+    GET /datasets - the datasets being served
+    GET /health - {"status": "ok"} plus cache statistics
+A POST to /query with a JSON object body takes the same fields.
+
+Usage: python weather_service.py file1.csv [file2.csv ...] [--port 8050] [--workers N]
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import collections
+import urllib.parse
+import multiprocessing
+import concurrent.futures
+import weather
+import weather_batch
+
+class ResultCache:
+    """
+    A least recently used cache that holds at most "maxEntries" results,
+    each for at most "maxAge" seconds
+    """
+    def __init__(self, maxEntries=256, maxAge=600.0):
+        self.maxEntries = maxEntries
+        self.maxAge = maxAge
+        self.entries = collections.OrderedDict()    #key -> (time stored, result), oldest use first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the cached result for "key", or None
+        """
+        entry = self.entries.get(key)
+        if entry != None and time.monotonic() - entry[0] > self.maxAge:
+            del self.entries[key]
+            entry = None
+        if entry == None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        self.entries[key] = (time.monotonic(), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+class QueryService:
+    """
+    Keeps datasets open and answers queries on them (see the module docstring)
+    """
+    def __init__(self, paths, workers=None, maxEntries=256, maxAge=600.0):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.datasets = {}      #path -> ((size, mtime), data)
+        self.cache = ResultCache(maxEntries, maxAge)
+        self.inFlight = {}      #key -> task
+        #the pool starts its workers lazily, while connections are open - forked from
+        #this process they would inherit the client sockets and keep them from closing
+        context = None
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def close(self):
+        self.pool.shutdown()
+
+    async def startWorkers(self):
+        """
+        Starts the worker processes (and imports weather in them) before any query arrives
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _ready) for worker in range(self.workers)])
+
+    async def query(self, fields):
+        """
+        Runs one query, given as a dictionary of query fields (strings or values)
+        Returns the JSON-ready result
+        """
+        query = self.parseQuery(fields)
+        stat = os.stat(query["file"])
+        key = tuple([query[field] for field in weather_batch.FIELDS]) + (stat.st_size, stat.st_mtime_ns)
+        result = self.cache.get(key)
+        if result != None:
+            return result
+        task = self.inFlight.get(key)
+        if task == None:
+            task = asyncio.ensure_future(self._run(query))
+            self.inFlight[key] = task
+            task.add_done_callback(lambda done: self.inFlight.pop(key, None))
+        result = await asyncio.shield(task)
+        self.cache.put(key, result)
+        return result
+
+    def parseQuery(self, fields):
+        """
+        Turns request fields into a weather_batch query with one value per field
+        Raises ValueError for fields that are missing, of the wrong type or out of range
+        """
+        if not isinstance(fields, dict):
+            raise ValueError("A query must be a JSON object")
+        unknown = set(fields) - set(weather_batch.FIELDS) - set(["aggregated"])
+        if unknown:
+            raise ValueError("Unknown query fields: " + ", ".join(sorted(unknown)))
+        if "product" not in fields:
+            raise ValueError("Every query needs a 'product'")
+        for field in weather_batch.FIELDS:
+            value = fields.get(field)
+            if value != None and (isinstance(value, bool) or not isinstance(value, (str, int))):
+                raise ValueError("'%s' must be a string or a whole number" % field)
+        query = {"file": self._datasetPath(fields.get("file"))}
+        for field in weather_batch.FIELDS[1:]:
+            value = fields.get(field, weather_batch.DEFAULTS.get(field))
+            if value == "" or value == "null":
+                value = None
+            if field in ("option", "month", "frequency") and value != None:
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ValueError("'%s' must be a whole number" % field)
+            if field == "window" and str(value).isdigit():
+                value = int(value)     #a run length - option 6 windows are season names or dates
+            if field in ("mode", "quality") and value != None and not isinstance(value, str):
+                raise ValueError("'%s' must be a string" % field)
+            query[field] = value
+        query["product"] = weather_batch._productCode(query["product"])
+        query["station"] = weather_batch._stationNumber(query["station"])
+        if query["mode"] != None:
+            query["mode"] = query["mode"].lower()
+        if query["quality"] != None:
+            query["quality"] = query["quality"].upper()
+        weather_batch._checkQuery(query)    #frequency between 0 and 2000 as getInput asks, mode, option and window
+        return query
+
+    async def _run(self, query):
+        loop = asyncio.get_running_loop()
+        data = await self._dataset(query["file"])
+        #filtering and aggregating are NumPy work on the warm data, the thresholds are pure Python
+        if query["station"] == None:
+            #every station separately, rather than merged into one series
+            stations = await loop.run_in_executor(None, weather.queryStations, data, query["product"],
+                                                  query["option"], query["month"], query["quality"], query["window"])
+            if stations == {}:
+                raise ValueError("No data fits the query")
+            result = {"stations": await loop.run_in_executor(self.pool, weather.queryStationThresholds, stations,
+                                                             query["frequency"], query["mode"])}
+        else:
+            agg_data = await loop.run_in_executor(None, weather.queryAggregate, data, query["product"],
+                                                  query["station"], query["option"], query["month"],
+                                                  query["quality"], query["window"])
+            if agg_data == {}:
+                raise ValueError("No data fits the query")
+            result = await loop.run_in_executor(self.pool, weather.queryThresholds, agg_data,
+                                                query["frequency"], query["mode"])
+        result["query"] = query
+        return result
+
+    async def _dataset(self, path):
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        opened = self.datasets.get(path)
+        if opened == None or opened[0] != version:
+            data = await asyncio.get_running_loop().run_in_executor(None, weather.openColumns, path)
+            opened = (version, data)
+            self.datasets[path] = opened
+        return opened[1]
+
+    def _datasetPath(self, name):
+        if name == None:
+            if len(self.paths) != 1:
+                raise ValueError("Several datasets are served - give a 'file'")
+            return self.paths[0]
+        for path in self.paths:
+            if name == path or os.path.abspath(name) == path or name == os.path.basename(path):
+                return path
+        raise ValueError("Unknown dataset: " + name)
+
+    async def handle(self, reader, writer):
+        """
+        Serves HTTP/1.1 requests on one connection
+        """
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                if int(headers.get("content-length", 0)) > 0:
+                    body = await reader.readexactly(int(headers["content-length"]))
+                method, target, version = requestLine.decode("latin-1").split()
+                status, response = await self._respond(method, target, body)
+                payload = json.dumps(response).encode("utf-8")
+                keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                              "Connection: %s\r\n\r\n" % (status, len(payload), "keep-alive" if keepAlive else "close")
+                              ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, body):
+        """
+        Returns the HTTP status and JSON-ready response to one request. Bad queries
+        get a 400 and anything else that goes wrong a 500, each with the "error"
+        """
+        try:
+            return await self._answer(method, urllib.parse.urlsplit(target), body)
+        except (ValueError, KeyError, AssertionError, OSError) as error:
+            return "400 Bad Request", {"error": str(error)}
+        except Exception as error:
+            return "500 Internal Server Error", {"error": "%s: %s" % (type(error).__name__, error)}
+
+    async def _answer(self, method, url, body):
+        if url.path == "/health":
+            return "200 OK", {"status": "ok", "cached": len(self.cache), "hits": self.cache.hits,
+                              "misses": self.cache.misses, "inFlight": len(self.inFlight)}
+        if url.path == "/datasets":
+            return "200 OK", {"datasets": self.paths}
+        if url.path != "/query":
+            return "404 Not Found", {"error": "Unknown path: " + url.path}
+        if method == "POST":
+            fields = json.loads(body.decode("utf-8") or "{}")
+        elif method == "GET":
+            fields = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        else:
+            return "405 Method Not Allowed", {"error": "Use GET or POST"}
+        result = await self.query(fields)
+        withAggregated = str(fields.get("aggregated", "")).lower() in ("1", "true", "yes")
+        if "stations" in result:
+            response = {"query": result["query"], "stations": {}}
+            for station, thresholds in result["stations"].items():
+                response["stations"][str(station)] = _thresholdResponse(thresholds, withAggregated)
+            return "200 OK", response
+        response = {"query": result["query"]}
+        response.update(_thresholdResponse(result, withAggregated))
+        return "200 OK", response
+
+def _ready():
+    return True
+
+def _thresholdResponse(result, withAggregated):
+    """
+    The JSON-ready thresholds (and aggregated series if asked for) of a queryThresholds result
+    """
+    response = {"thresholdA": result["thresholdA"], "thresholdB": result["thresholdB"]}
+    if withAggregated:
+        response["aggregated"] = dict([(str(key), value) for key, value in result["aggregated"].items()])
+    return response
+
+async def serve(paths, host="127.0.0.1", port=8050, workers=None, maxEntries=256, maxAge=600.0):
+    """
+    Runs the service until it is cancelled
+    """
+    service = QueryService(paths, workers, maxEntries, maxAge)
+    try:
+        await service.startWorkers()
+        for path in service.paths:
+            await service._dataset(path)    #warm every dataset before taking queries
+        server = await asyncio.start_server(service.handle, host, port)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve weather queries over HTTP")
+    parser.add_argument("files", nargs="+", help="BOM .csv files to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--workers", type=int, help="threshold worker processes (default: all cores)")
+    parser.add_argument("--cache-entries", type=int, default=256, help="results kept in the cache (default: 256)")
+    parser.add_argument("--cache-age", type=float, default=600.0, help="seconds a result stays cached (default: 600)")
+    args = parser.parse_args(argv)
+
+    print("Serving", ", ".join(args.files), "on http://%s:%d" % (args.host, args.port))
+    try:
+        asyncio.run(serve(args.files, args.host, args.port, args.workers, args.cache_entries, args.cache_age))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()